@@ -1,15 +1,19 @@
 import customtkinter as ctk
 import tkinter as tk
 from tkinter import ttk, simpledialog, messagebox
-from datetime import datetime, timedelta, time
-import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import google.generativeai as genai
+from datetime import datetime, timedelta
+import importlib.util
 import os
 import sys
+import threading
 import re 
+import numpy as np
+from journal import to_timestamp
+from rollup import period_dates
+from meter import daily_usage_seconds, usage_seconds
+from meterd import open_meter, MeterError
+from storage import UserLockedError
+import recommendations
 
 # --- Dependency Checker ---
 def check_and_install_packages():
@@ -17,9 +21,8 @@ def check_and_install_packages():
     required_packages = ['pandas', 'seaborn', 'matplotlib']
     missing_packages = []
     for package in required_packages:
-        try:
-            __import__(package)
-        except ImportError:
+        # find_spec locates the package without paying for importing it.
+        if importlib.util.find_spec(package) is None:
             missing_packages.append(package)
 
     if missing_packages:
@@ -32,43 +35,217 @@ def check_and_install_packages():
 
 check_and_install_packages()
 
+# --- Lazily Loaded Libraries ---
+# pandas, seaborn, matplotlib and google.generativeai take seconds to import and the
+# Home tab never needs them, so they are loaded the first time Stats or AI is used.
+_chart_style_applied = False
+
+def load_charting():
+    """Imports pandas and matplotlib on first use and applies the seaborn chart style once."""
+    global _chart_style_applied
+    import pandas as pd
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+    if not _chart_style_applied:
+        import seaborn as sns
+        sns.set_style("whitegrid")
+        sns.set_palette("viridis")
+        _chart_style_applied = True
+    return pd, plt, FigureCanvasTkAgg
+
+def load_genai():
+    """Imports the Gemini client on first use."""
+    import google.generativeai as genai
+    return genai
+
+# --- Stats Tables ---
+# Stats tab windows: label -> (days covered, rollup tier it is read from). Longer windows
+# use coarser tiers, so every view is a few dozen lookups however far back it reaches.
+STATS_WINDOWS = {
+    "7 days": (7, "day"),
+    "30 days": (30, "day"),
+    "90 days": (90, "week"),
+    "365 days": (365, "month"),
+}
+# Per tier: strftime format of a column header, and the name of the current period.
+PERIOD_LABELS = {"day": ("%b %d", "Today"), "week": ("Wk %b %d", "This Week"), "month": ("%b %Y", "This Month")}
+
+def usage_table(pd, usage_seconds, devices, columns):
+    """Returns a DataFrame of kWh with one row per device (sorted) and one column per entry of columns.
+
+    usage_seconds maps (column, device name) to ON seconds; it is pivoted in one step and
+    converted with a single multiply by each row's power rating.
+    """
+    names = sorted({d.name for d in devices} | {name for _, name in usage_seconds})
+    if not usage_seconds:
+        return pd.DataFrame(0.0, index=names, columns=columns)
+    frame = pd.DataFrame(list(usage_seconds), columns=["column", "device"])
+    frame["seconds"] = np.fromiter(usage_seconds.values(), dtype=float, count=len(usage_seconds))
+    table = frame.pivot(index="device", columns="column", values="seconds").reindex(index=names, columns=columns).fillna(0.0)
+    # Usage of devices that no longer exist has no power rating and counts as 0 kWh.
+    power = pd.Series({d.name: d.power for d in devices}, dtype=float).reindex(names).fillna(0.0).to_numpy()
+    return table.mul(power / (1000 * 3600), axis=0)
+
+def format_units(df):
+    """Formats a kWh table as display strings column-wise, returning one list per row."""
+    # One bound format applied per column beats per-cell f-strings and np.char.mod alike.
+    columns = [list(map("{:.3f}".format, column)) for column in df.to_numpy(dtype=float).T.tolist()]
+    return [list(row) for row in zip(*columns)] if columns else [[] for _ in df.index]
+
 # --- Main App Configuration ---
 ctk.set_appearance_mode("System")
 ctk.set_default_color_theme("blue")
-sns.set_style("whitegrid")
-sns.set_palette("viridis")
-
-class Device:
-    """Represents a single electrical device with power rating and usage tracking."""
-    def __init__(self, name, power):
-        self.name = name
-        self.power = power
-        self.is_on = False
-        self.session_usage_seconds = 0
-        self.saved_usage_units = 0.0
-        self.last_on_time = None
-
-    def toggle(self):
-        if self.is_on:
-            self.is_on = False
-            if self.last_on_time:
-                self.session_usage_seconds += (datetime.now() - self.last_on_time).total_seconds()
-                self.last_on_time = None
-        else:
-            self.is_on = True
-            self.last_on_time = datetime.now()
 
-    def update_session_usage(self):
-        if self.is_on and self.last_on_time:
-            now = datetime.now()
-            self.session_usage_seconds += (now - self.last_on_time).total_seconds()
-            self.last_on_time = now
+def setup_tree_styles():
+    """Configures the ttk styles of the Stats and Leaderboard tables; called once at startup."""
+    style = ttk.Style()
+    style.theme_use("default")
+    style.configure("Stats.Treeview", background="#222831", foreground="#EEEEEE", fieldbackground="#222831", borderwidth=0, rowheight=25)
+    style.configure("Stats.Treeview.Heading", background="#393E46", foreground="#FFD369", font=('Arial', 11, 'bold'))
+    style.map("Stats.Treeview", background=[('selected', '#FFD369')])
+    # Taller rows leave room for the medal and the bigger first-place font.
+    style.configure("Leaderboard.Treeview", background="#222831", foreground="#EEEEEE", fieldbackground="#222831", borderwidth=0, rowheight=35)
+    style.configure("Leaderboard.Treeview.Heading", background="#393E46", foreground="#FFD369", font=('Arial', 12, 'bold'))
+    style.map("Leaderboard.Treeview", background=[('selected', '#FFD369')])
+
+def sync_treeview(tree, rows, shown):
+    """Brings a Treeview in line with rows, a list of (iid, values, tags) in display order.
+
+    shown maps each iid in the tree to the (values, tags) it displays and is kept up to
+    date here, so only rows that were added, removed, changed or moved touch the widget.
+    """
+    wanted = {iid for iid, _, _ in rows}
+    for iid in [iid for iid in shown if iid not in wanted]:
+        tree.delete(iid)
+        del shown[iid]
+    order = list(tree.get_children())
+    for index, (iid, values, tags) in enumerate(rows):
+        state = (tuple(values), tuple(tags))
+        if iid not in shown:
+            tree.insert('', index, iid=iid, values=state[0], tags=state[1])
+            order.insert(index, iid)
+        else:
+            if shown[iid] != state:
+                tree.item(iid, values=state[0], tags=state[1])
+            if order[index] != iid:
+                tree.move(iid, '', index)
+                order.remove(iid)
+                order.insert(index, iid)
+        shown[iid] = state
+
+class DeviceListView(ctk.CTkFrame):
+    """Scrollable device list that recycles a fixed pool of row widgets.
+
+    Only as many rows as fit in the visible area are ever created; scrolling rebinds them
+    to other devices, so startup and scrolling cost stays flat however many devices exist.
+    """
+    ROW_HEIGHT = 48
+    SCROLL_ROWS = 3
+
+    def __init__(self, master, devices, on_toggle, on_remove, **kwargs):
+        super().__init__(master, **kwargs)
+        self.devices = devices
+        self.on_toggle = on_toggle
+        self.on_remove = on_remove
+        self.offset = 0
+        self.visible_rows = 0
+        self.rows = []
+        self.scrollbar = ctk.CTkScrollbar(self, command=self._on_scrollbar)
+        self.scrollbar.pack(side="right", fill="y")
+        self.viewport = ctk.CTkFrame(self, fg_color="transparent")
+        self.viewport.pack(side="left", fill="both", expand=True)
+        self.viewport.bind("<Configure>", self._on_resize)
+        self._bind_mousewheel(self.viewport)
+
+    def _bind_mousewheel(self, widget):
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            widget.bind(sequence, self._on_mousewheel)
+
+    def _make_row(self):
+        row = {"device": None, "name_text": None, "usage_text": None, "is_on": None, "placed": False}
+        row["frame"] = ctk.CTkFrame(self.viewport, fg_color="#222831", corner_radius=8)
+        row["name_label"] = ctk.CTkLabel(row["frame"], text="", font=("Arial", 14), text_color="#FFD369")
+        row["name_label"].pack(side="left", padx=10, pady=5)
+        row["usage_label"] = ctk.CTkLabel(row["frame"], text="", font=("Arial", 14), text_color="#FFFFFF")
+        row["usage_label"].pack(side="left", padx=10, pady=5)
+        row["toggle_btn"] = ctk.CTkButton(row["frame"], text="Turn ON", width=80, command=lambda r=row: self.on_toggle(r["device"]))
+        row["toggle_btn"].pack(side="right", padx=10, pady=5)
+        remove_btn = ctk.CTkButton(row["frame"], text="Remove", width=80, fg_color="#E84545", hover_color="#B83B3B", command=lambda r=row: self.on_remove(r["device"]))
+        remove_btn.pack(side="right", padx=5, pady=5)
+        for widget in (row["frame"], row["name_label"], row["usage_label"]):
+            self._bind_mousewheel(widget)
+        return row
+
+    def _on_resize(self, event):
+        # event.height is in screen pixels, while place(y=...) scales ROW_HEIGHT by the widget scaling.
+        self.visible_rows = max(1, int(event.height // self._apply_widget_scaling(self.ROW_HEIGHT)))
+        while len(self.rows) < self.visible_rows:
+            self.rows.append(self._make_row())
+        self.refresh()
+
+    def _on_scrollbar(self, action, amount, unit=None):
+        if action == "moveto":
+            self.scroll_to(round(float(amount) * len(self.devices)))
+        else:
+            step = self.visible_rows if unit == "pages" else 1
+            self.scroll_to(self.offset + int(amount) * step)
+
+    def _on_mousewheel(self, event):
+        # Windows/macOS report a signed delta; X11 sends Button-4 (up) and Button-5 (down).
+        direction = -1 if event.num == 4 or event.delta > 0 else 1
+        self.scroll_to(self.offset + direction * self.SCROLL_ROWS)
+
+    def scroll_to(self, offset):
+        offset = max(0, min(offset, len(self.devices) - self.visible_rows))
+        if offset != self.offset:
+            self.offset = offset
+            self.refresh()
+
+    def _set_row_usage(self, row):
+        usage_text = f"Usage: {row['device'].get_total_units():.3f} units"
+        if usage_text != row["usage_text"]:
+            row["usage_label"].configure(text=usage_text)
+            row["usage_text"] = usage_text
+
+    def _bind_row(self, row, device):
+        """Points a recycled row at a device, touching only the widgets whose content changed."""
+        row["device"] = device
+        name_text = f"{device.name} ({device.power}W)"
+        if name_text != row["name_text"]:
+            row["name_label"].configure(text=name_text)
+            row["name_text"] = name_text
+        self._set_row_usage(row)
+        if device.is_on != row["is_on"]:
+            if device.is_on:
+                row["toggle_btn"].configure(text="Turn OFF", fg_color="#E84545", hover_color="#B83B3B")
+            else:
+                row["toggle_btn"].configure(text="Turn ON", fg_color=ctk.ThemeManager.theme["CTkButton"]["fg_color"], hover_color=ctk.ThemeManager.theme["CTkButton"]["hover_color"])
+            row["is_on"] = device.is_on
+
+    def refresh(self):
+        """Rebinds the visible rows after scrolling or a change to the device list."""
+        self.offset = max(0, min(self.offset, len(self.devices) - self.visible_rows))
+        for i, row in enumerate(self.rows):
+            index = self.offset + i
+            if i < self.visible_rows and index < len(self.devices):
+                self._bind_row(row, self.devices[index])
+                if not row["placed"]:
+                    row["frame"].place(x=0, y=i * self.ROW_HEIGHT + 4, relwidth=1)
+                    row["placed"] = True
+            elif row["placed"]:
+                row["frame"].place_forget()
+                row["device"], row["placed"] = None, False
+        if self.devices:
+            self.scrollbar.set(self.offset / len(self.devices), min(1.0, (self.offset + self.visible_rows) / len(self.devices)))
+        else:
+            self.scrollbar.set(0.0, 1.0)
 
-    def get_session_units(self):
-        return (self.power * self.session_usage_seconds) / (1000 * 3600)
+    def refresh_usages(self):
+        """Updates the usage text of visible rows whose device is running."""
+        for row in self.rows:
+            if row["placed"] and row["device"].is_on:
+                self._set_row_usage(row)
 
-    def get_total_units(self):
-        return self.saved_usage_units + self.get_session_units()
 
 class App(ctk.CTk):
     """The main application window for the Power Usage Tracker."""
@@ -78,13 +255,25 @@ class App(ctk.CTk):
         self.title(f"Device Power Usage Tracker - {self.username}")
         self.geometry("850x700")
 
-        self.devices = []
-        self.device_widgets = []
-        
-        self.data_file = f"{self.username}_data.txt"
+        # The meter owns the devices and records their events, either in-process or in the
+        # meterd daemon (WATTWISE_DAEMON) so accounting outlives the window.
+        self.meter = open_meter(self.username)
+        self.devices = self.meter.devices
+        self.store = self.meter.store
         self.is_closing = False
-
-        self.tabview = ctk.CTkTabview(self)
+        self.ai_job = None
+        self.ai_model = None
+        self.ai_model_api_key = None
+        self.ai_model_lock = threading.Lock()  # A cancelled job's thread may still be setting the model up.
+        self.ai_cache = recommendations.RecommendationCache(f"{self.username}_ai_cache.json")
+
+        self.stats_dirty = True
+        self.stats_date = None  # The day Stats was last rendered for; its columns end there.
+        self.leaderboard_dirty = True
+        self.leaderboard_signature = None
+
+        # Tab switches render through the tabview's command callback instead of polling.
+        self.tabview = ctk.CTkTabview(self, command=self.on_tab_change)
         self.tabview.pack(fill="both", expand=True, padx=10, pady=10)
         self.tabview.configure(
             fg_color="#393E46",
@@ -99,6 +288,7 @@ class App(ctk.CTk):
         self.stats_tab = self.tabview.add("  Stats  ")
         self.leaderboard_tab = self.tabview.add("Leaderboard") # Added Leaderboard Tab
 
+        setup_tree_styles()
         self.setup_home_tab()
         self.setup_stats_tab()
         self.setup_leaderboard_tab() # Setup the leaderboard tab
@@ -106,8 +296,6 @@ class App(ctk.CTk):
         self.load_state()
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
 
-        self.last_selected_tab = "Home"
-        self.check_tab_change()
         self.update_all_usages()
 
     def setup_home_tab(self):
@@ -125,9 +313,10 @@ class App(ctk.CTk):
         self.power_entry.pack(side="left", padx=5, expand=True, fill="x")
         self.add_btn = ctk.CTkButton(add_frame, text="Add Device", command=self.add_device, fg_color="#FFD369", text_color="#222831", font=("Arial", 16, "bold"), height=40, width=140, corner_radius=10)
         self.add_btn.pack(side="left", padx=5)
-        self.devices_frame = ctk.CTkScrollableFrame(self.home_tab, fg_color="transparent")
-        self.devices_frame.pack(pady=10, padx=10, fill="both", expand=True)
-        self.total_usage_label = ctk.CTkLabel(self.home_tab, text="Total Usage: 0.000 units", font=("Arial", 18, "bold"), text_color="#FFD369")
+        self.device_list = DeviceListView(self.home_tab, self.devices, on_toggle=self.toggle_device, on_remove=self.remove_device, fg_color="transparent")
+        self.device_list.pack(pady=10, padx=10, fill="both", expand=True)
+        self.total_usage_text = "Total Usage: 0.000 units"
+        self.total_usage_label = ctk.CTkLabel(self.home_tab, text=self.total_usage_text, font=("Arial", 18, "bold"), text_color="#FFD369")
         self.total_usage_label.pack(pady=10)
         
         self.recommendation_label = ctk.CTkLabel(self.home_tab, text="AI Recommendations:", font=("Arial", 14, "bold"), text_color="#FFD369")
@@ -152,8 +341,12 @@ class App(ctk.CTk):
         self.recommendation_box.tag_configure("italic", font=("Arial", 14, "italic"))
         self.recommendation_box.tag_configure("underline", underline=True)
         
-        self.recommend_btn = ctk.CTkButton(self.home_tab, text="Get Recommendations", command=self.get_ai_recommendations, fg_color="#FFD369", text_color="#222831", font=("Arial", 16, "bold"), height=40, width=220, corner_radius=10)
-        self.recommend_btn.pack(pady=(0, 10))
+        recommend_frame = ctk.CTkFrame(self.home_tab, fg_color="transparent")
+        recommend_frame.pack(pady=(0, 10))
+        self.recommend_btn = ctk.CTkButton(recommend_frame, text="Get Recommendations", command=self.get_ai_recommendations, fg_color="#FFD369", text_color="#222831", font=("Arial", 16, "bold"), height=40, width=220, corner_radius=10)
+        self.recommend_btn.pack(side="left", padx=5)
+        self.cancel_recommend_btn = ctk.CTkButton(recommend_frame, text="Cancel", command=self.cancel_ai_recommendations, state="disabled", fg_color="#E84545", hover_color="#B83B3B", font=("Arial", 16, "bold"), height=40, width=100, corner_radius=10)
+        self.cancel_recommend_btn.pack(side="left", padx=5)
         clock_frame = ctk.CTkFrame(self.home_tab, fg_color="transparent")
         clock_frame.place(relx=1.0, rely=1.0, anchor="se", x=-10, y=-10)
         self.clock_time_label = ctk.CTkLabel(clock_frame, text="", font=("Arial", 32, "bold"), text_color="#FFD369")
@@ -164,26 +357,92 @@ class App(ctk.CTk):
 
     def setup_stats_tab(self):
         self.stats_frame = ctk.CTkFrame(self.stats_tab, fg_color="transparent")
-        self.stats_frame.pack(fill="both", expand=True, padx=10, pady=10)
+        self.stats_frame.pack(fill="x", padx=10, pady=(10, 0))
+
+        # The table is built once too; show_stats updates its rows in place.
+        header_frame = ctk.CTkFrame(self.stats_frame, fg_color="transparent")
+        header_frame.pack(fill="x", pady=(5,10))
+        self.stats_window = "7 days"
+        self.stats_title = ctk.CTkLabel(header_frame, text="Last 7 Days Usage (Units/kWh)", font=("Arial", 16, "bold"), text_color="#FFD369")
+        self.stats_title.pack(side="left", padx=10)
+        self.stats_window_selector = ctk.CTkSegmentedButton(header_frame, values=list(STATS_WINDOWS), command=self._on_stats_window,
+                                                            selected_color="#FFD369", selected_hover_color="#FFD369", text_color="#222831")
+        self.stats_window_selector.set(self.stats_window)
+        self.stats_window_selector.pack(side="right", padx=10)
+        self.stats_message = ctk.CTkLabel(self.stats_frame, text="", font=("Arial", 16))
+        self.stats_tree_frame = ctk.CTkFrame(self.stats_frame, fg_color="transparent")
+        tree_scroll_x = ttk.Scrollbar(self.stats_tree_frame, orient="horizontal")
+        self.stats_tree = ttk.Treeview(self.stats_tree_frame, columns=['Device'], show='headings',
+                                       height=0, style="Stats.Treeview", xscrollcommand=tree_scroll_x.set)
+        tree_scroll_x.config(command=self.stats_tree.xview)
+        tree_scroll_x.pack(side="bottom", fill="x")
+        self.stats_tree.pack(fill="both", expand=True)
+        self.stats_headers = None
+        self.stats_rows = {}
+
+        # The pie chart section is built once; show_stats only redraws the wedges.
+        self.pie_title = ctk.CTkLabel(self.stats_tab, text=f"Today's Consumption Distribution", font=("Arial", 16, "bold"), text_color="#FFD369")
+        self.pie_title.pack(pady=(20,10))
+        self.pie_frame = ctk.CTkFrame(self.stats_tab, fg_color="#393E46")
+        self.pie_frame.pack(fill="both", expand=True, padx=20, pady=(0, 20))
+        self.pie_empty_label = ctk.CTkLabel(self.pie_frame, text=f"No usage recorded for Today.", font=("Arial", 14), text_color="#EEEEEE")
+        self.pie_figure = None
+        self.pie_axes = None
+        self.pie_canvas = None
 
     # --- New method for Leaderboard Tab Setup ---
     def setup_leaderboard_tab(self):
-        # This tab will be populated dynamically by show_leaderboard
-        pass # Initial setup is minimal, content is generated on tab switch
+        # Built once; show_leaderboard only updates the rows that changed.
+        ctk.CTkLabel(self.leaderboard_tab, text="Energy Efficiency Leaderboard", font=("Arial", 20, "bold"), text_color="#FFD369").pack(pady=(10,20))
+        self.leaderboard_message = ctk.CTkLabel(self.leaderboard_tab, text="No users found for leaderboard. Create more user data files.", font=("Arial", 16))
+        self.leaderboard_tree_frame = ctk.CTkFrame(self.leaderboard_tab, fg_color="transparent")
+        self.leaderboard_tree_frame.pack(fill="both", expand=True, padx=10)
+
+        columns = ['Rank', 'User', 'Total_Usage']
+        self.leaderboard_tree = ttk.Treeview(self.leaderboard_tree_frame, columns=columns, show='headings', height=0, style="Leaderboard.Treeview")
+        tree = self.leaderboard_tree
+
+        # Configure column headings and widths
+        tree.heading('Rank', text='Rank'); tree.column('Rank', anchor='center', width=60)
+        tree.heading('User', text='User'); tree.column('User', anchor='w', width=200) # Left-align User names
+        tree.heading('Total_Usage', text='Total Usage (Units)'); tree.column('Total_Usage', anchor='center', width=150)
+
+        # Define tags for special formatting
+        # You can adjust the font size for 'top_rank_bold' here (e.g., 18 or 20)
+        tree.tag_configure('top_rank_bold', font=('Arial', 18, 'bold'), foreground='#FFD369') # Bigger font and highlight color
+        tree.tag_configure('current_user_highlight', background='#5cb85c', foreground='#FFFFFF') # Highlight current user with green
+        tree.pack(fill="both", expand=True)
+        self.leaderboard_rows = {}
+
+        self.leaderboard_note = ctk.CTkLabel(self.leaderboard_tab, text="*Total Usage includes all saved and current session units for all users.", font=("Arial", 10), text_color="#EEEEEE")
+        self.leaderboard_note.pack(pady=(5,0))
+        ctk.CTkLabel(self.leaderboard_tab, text="**Leaderboard updates based on last saved state of each user.", font=("Arial", 10), text_color="#EEEEEE").pack(pady=(0,5))
 
-    def check_tab_change(self):
+    def on_tab_change(self):
+        """Renders the newly selected tab, skipping views whose data has not changed."""
         if self.is_closing: return
         try:
             current_tab = self.tabview.get()
-            if current_tab != self.last_selected_tab:
-                self.last_selected_tab = current_tab
-                if current_tab == "  Stats  ":
+            # Running devices keep accumulating usage, so their views are always stale.
+            any_running = self.devices.any_on()
+            if current_tab == "  Stats  ":
+                # After midnight the columns shift a day even if no usage changed.
+                if self.stats_dirty or any_running or self.stats_date != datetime.now().date():
+                    self.stats_dirty = False
                     self.show_stats()
-                elif current_tab == "Leaderboard": # Call show_leaderboard when tab is selected
+            elif current_tab == "Leaderboard":
+                # Other users' saves show up as a change to the index or the data directory.
+                signature = self.store.signature()
+                if self.leaderboard_dirty or any_running or signature != self.leaderboard_signature:
+                    self.leaderboard_dirty = False
+                    self.leaderboard_signature = signature
                     self.show_leaderboard()
         except Exception as e:
-            print(f"Error in check_tab_change: {e}")
-        self.after(250, self.check_tab_change)
+            print(f"Error in on_tab_change: {e}")
+
+    def _mark_data_dirty(self):
+        self.stats_dirty = True
+        self.leaderboard_dirty = True
 
     def update_clock(self):
         if self.is_closing: return
@@ -200,85 +459,63 @@ class App(ctk.CTk):
             messagebox.showerror("Invalid Input", "Please enter a valid number for power.")
             return
         if name and power > 0:
-            if any(d.name == name for d in self.devices):
+            if name in self.devices:
                 messagebox.showwarning("Duplicate Device", f"A device named '{name}' already exists.")
                 return
-            device = Device(name, power)
-            self.devices.append(device)
-            self.add_device_widget(device)
+            try:
+                self.meter.add_device(name, power)
+            except (IOError, MeterError) as e:
+                print(f"Error adding device: {e}")
+                return
+            self.device_list.refresh()
+            self._mark_data_dirty()
             self.name_entry.delete(0, tk.END)
             self.power_entry.delete(0, tk.END)
         else:
             messagebox.showwarning("Invalid Input", "Device name cannot be empty and power must be greater than zero.")
 
-    def add_device_widget(self, device):
-        frame = ctk.CTkFrame(self.devices_frame, fg_color="#222831", corner_radius=8)
-        frame.pack(fill="x", pady=4, padx=4)
-        name_label = ctk.CTkLabel(frame, text=f"{device.name} ({device.power}W)", font=("Arial", 14), text_color="#FFD369")
-        name_label.pack(side="left", padx=10, pady=5)
-        usage_label = ctk.CTkLabel(frame, text=f"Usage: {device.get_total_units():.3f} units", font=("Arial", 14), text_color="#FFFFFF")
-        usage_label.pack(side="left", padx=10, pady=5)
-        toggle_btn = ctk.CTkButton(frame, text="Turn ON", width=80, command=lambda d=device, b=frame: self.toggle_device(d, b))
-        toggle_btn.pack(side="right", padx=10, pady=5)
-        remove_btn = ctk.CTkButton(frame, text="Remove", width=80, fg_color="#E84545", hover_color="#B83B3B", command=lambda d=device, f=frame: self.remove_device(d, f))
-        remove_btn.pack(side="right", padx=5, pady=5)
-        self.device_widgets.append({"device": device, "usage_label": usage_label, "frame": frame, "toggle_btn": toggle_btn})
-        if device.is_on:
-            toggle_btn.configure(text="Turn OFF", fg_color="#E84545", hover_color="#B83B3B")
-
-    def remove_device(self, device_to_remove, frame):
-        if device_to_remove.is_on:
-            device_to_remove.toggle() 
-            log_message = f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {device_to_remove.name} turned OFF (Removed)\n"
-            try:
-                with open(self.data_file, "a") as f:
-                    f.write(log_message)
-            except IOError as e:
-                print(f"Error logging device removal: {e}")
-        device_to_remove.saved_usage_units += device_to_remove.get_session_units()
-        device_to_remove.session_usage_seconds = 0
-        self.devices.remove(device_to_remove)
-        self.device_widgets = [dw for dw in self.device_widgets if dw["device"] != device_to_remove]
-        frame.destroy()
-        self.update_all_usages()
-        self.save_state()
-
-    def toggle_device(self, device, frame):
-        device.toggle()
-        toggle_button = frame.winfo_children()[2]
-        if device.is_on:
-            toggle_button.configure(text="Turn OFF", fg_color="#E84545", hover_color="#B83B3B")
-        else:
-            toggle_button.configure(text="Turn ON", fg_color=ctk.ThemeManager.theme["CTkButton"]["fg_color"], hover_color=ctk.ThemeManager.theme["CTkButton"]["hover_color"])
-        now = datetime.now()
-        log_message = f"[{now.strftime('%Y-%m-%d %H:%M:%S')}] {device.name} turned {'ON' if device.is_on else 'OFF'}\n"
+    def remove_device(self, device_to_remove):
         try:
-            with open(self.data_file, "a") as f:
-                f.write(log_message)
-        except IOError as e:
-            print(f"Error writing to log file: {e}")
+            self.meter.remove_device(device_to_remove.name)
+        except (IOError, MeterError) as e:
+            print(f"Error removing device: {e}")
+        self._mark_data_dirty()
+        self.device_list.refresh()
+        self.refresh_usages()
+
+    def toggle_device(self, device):
+        try:
+            # The state the user saw is sent, so a click on a stale button cannot undo someone else's toggle.
+            self.meter.toggle(device.name, on=not device.is_on)
+        except (IOError, MeterError) as e:
+            print(f"Error toggling device: {e}")
+        self._mark_data_dirty()
+        # Rebinding updates the button and, for a device just turned off, its final usage.
+        self.device_list.refresh()
+
+    def refresh_usages(self):
+        """Advances running devices to a single shared clock reading and refreshes changed labels."""
+        self.devices.update_sessions(datetime.now())
+        grand_total_usage = self.devices.total_units()
+        self.device_list.refresh_usages()
+        total_text = f"Total Usage: {grand_total_usage:.3f} units"
+        if total_text != self.total_usage_text:
+            self.total_usage_label.configure(text=total_text)
+            self.total_usage_text = total_text
 
     def update_all_usages(self):
         if self.is_closing: return
-        grand_total_usage = 0
-        for dw in self.device_widgets:
-            device = dw["device"]
-            usage_label = dw["usage_label"]
-            device.update_session_usage()
-            device_total = device.get_total_units()
-            usage_label.configure(text=f"Usage: {device_total:.3f} units")
-            grand_total_usage += device_total
-        self.total_usage_label.configure(text=f"Total Usage: {grand_total_usage:.3f} units")
+        try:
+            if self.meter.refresh():
+                self._mark_data_dirty()
+                self.device_list.refresh()
+        except (IOError, MeterError):
+            pass  # The daemon is unreachable; the next tick tries again.
+        self.refresh_usages()
         self.after(1000, self.update_all_usages)
 
     def _consolidate_session_usage(self):
-        for dw in self.device_widgets:
-            device = dw["device"]
-            if device.is_on and device.last_on_time:
-                device.session_usage_seconds += (datetime.now() - device.last_on_time).total_seconds()
-                device.last_on_time = datetime.now() 
-            device.saved_usage_units += device.get_session_units()
-            device.session_usage_seconds = 0
+        self.meter.consolidate()
 
     def save_usage(self):
         self._consolidate_session_usage()
@@ -286,215 +523,139 @@ class App(ctk.CTk):
         messagebox.showinfo("Saved", "Current device usage has been saved successfully.")
         
     def load_state(self):
-        if not os.path.exists(self.data_file): 
+        found = self.meter.load()
+        self.device_list.refresh()
+
+        if not found: 
             if not self.username.startswith("Guest"):
                 if messagebox.askyesno("AI Setup", "No data file found. Would you like to set up AI recommendations now? (Requires Google API Key)"):
                     self.prompt_for_api_key()
             return
-            
-        with open(self.data_file, "r") as f: lines = f.readlines()
-        in_devices_section = False
-        for line in lines:
-            stripped = line.strip()
-            if not stripped: continue
-            if stripped == "## DEVICES ##": in_devices_section = True; continue
-            if stripped == "## LOGS ##": in_devices_section = False; break
-            if in_devices_section:
-                try:
-                    info_part, usage_part = stripped.split(" | ")
-                    name_part, power_part = info_part.split(" (")
-                    name = name_part.strip()
-                    power = float(power_part.split("W)")[0])
-                    saved_usage = float(usage_part)
-                    device = Device(name, power)
-                    device.saved_usage_units = saved_usage
-                    self.devices.append(device)
-                    self.add_device_widget(device)
-                except Exception as e:
-                    print(f"Failed to load device line: '{stripped}' - Error: {e}")
         
         if os.getenv("GOOGLE_API_KEY") is None:
             if messagebox.askyesno("AI Setup", "Google API Key is not set. Would you like to add it now for AI recommendations?"):
                 self.prompt_for_api_key()
 
     def save_state(self):
-        logs = []
-        if os.path.exists(self.data_file):
-            with open(self.data_file, "r") as f:
-                in_logs_section = False
-                for line in f:
-                    if line.strip() == "## LOGS ##": in_logs_section = True; continue
-                    if in_logs_section: logs.append(line)
-        with open(self.data_file, "w") as f:
-            f.write("## DEVICES ##\n")
-            for device in self.devices:
-                f.write(f"{device.name} ({device.power}W) | {device.saved_usage_units}\n")
-            f.write("\n## LOGS ##\n")
-            f.writelines(logs)
+        self.meter.save()
+        self._mark_data_dirty()
         print(f"State saved for {self.username}")
 
     def on_closing(self):
         self.is_closing = True
-        self._consolidate_session_usage()
-        self.save_state()
+        if self.ai_job:
+            self.ai_job.cancel()
+        try:
+            self._consolidate_session_usage()
+            self.save_state()
+        finally:
+            # Commits any queued events; a daemon-backed meter just disconnects and keeps metering.
+            self.meter.close()
         self.destroy()
 
+    def _on_stats_window(self, window):
+        self.stats_window = window
+        self.show_stats()
+
     def show_stats(self):
-        for widget in self.stats_frame.winfo_children():
-            widget.destroy()
-        
-        plt.close('all')
+        pd, _, _ = load_charting()
+        days, period = STATS_WINDOWS[self.stats_window]
+        header_format, current_label = PERIOD_LABELS[period]
+        self.stats_title.configure(text=f"Last {days} Days Usage (Units/kWh)")
+        self.pie_title.configure(text=f"{current_label}'s Consumption Distribution")
+        self.pie_empty_label.configure(text=f"No usage recorded for {current_label}.")
 
         try:
-            device_power_map = {d.name: d.power for d in self.devices}
-            
-            daily_usage_seconds_cumulative = {}
-            
-            if os.path.exists(self.data_file):
-                with open(self.data_file, 'r') as f:
-                    lines = f.readlines()
-                
-                logs_section_started = False
-                processed_logs = []
-                for line in lines:
-                    stripped_line = line.strip()
-                    if stripped_line == "## LOGS ##":
-                        logs_section_started = True
-                        continue
-                    if not logs_section_started or not stripped_line:
-                        continue
-                    
-                    try:
-                        timestamp_str = stripped_line[1:20]
-                        dt_obj = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
-                        status_part_raw = stripped_line[22:]
-                        device_name = status_part_raw.split(' turned ')[0].strip()
-                        status = status_part_raw.split(' turned ')[1].split(' ')[0].strip()
-                        
-                        processed_logs.append({'timestamp': dt_obj, 'device': device_name, 'status': status})
-                    except (ValueError, IndexError):
-                        continue
-                
-                open_sessions = {}
-                for log in sorted(processed_logs, key=lambda x: x['timestamp']):
-                    device_name = log['device']
-                    if device_name not in device_power_map: continue
-
-                    if log['status'] == 'ON':
-                        open_sessions[device_name] = log['timestamp']
-                    elif log['status'] == 'OFF' and device_name in open_sessions:
-                        start_time = open_sessions.pop(device_name)
-                        end_time = log['timestamp']
-                        
-                        current_date_iter = start_time.date()
-                        while current_date_iter <= end_time.date():
-                            day_start = datetime.combine(current_date_iter, time.min)
-                            day_end = datetime.combine(current_date_iter, time.max)
-                            
-                            session_start_on_day = max(start_time, day_start)
-                            session_end_on_day = min(end_time, day_end)
-                            
-                            duration = (session_end_on_day - session_start_on_day).total_seconds()
-                            if duration > 0:
-                                key = (current_date_iter, device_name)
-                                daily_usage_seconds_cumulative[key] = daily_usage_seconds_cumulative.get(key, 0) + duration
-                            current_date_iter += timedelta(days=1)
-            
             now = datetime.now()
-            today_date_only = now.date()
-            for device in self.devices:
-                if device.is_on and device.last_on_time:
-                    start_time = device.last_on_time
-                    end_time = now
-                    
-                    current_date_iter = start_time.date()
-                    while current_date_iter <= end_time.date():
-                        day_start = datetime.combine(current_date_iter, time.min)
-                        day_end = datetime.combine(current_date_iter, time.max)
-                        
-                        session_start_on_day = max(start_time, day_start)
-                        session_end_on_day = min(end_time, day_end)
-                        
-                        duration = (session_end_on_day - session_start_on_day).total_seconds()
-                        if duration > 0:
-                            key = (current_date_iter, device.name)
-                            daily_usage_seconds_cumulative[key] = daily_usage_seconds_cumulative.get(key, 0) + duration
-                        current_date_iter += timedelta(days=1)
+            self.stats_date = now.date()
+            # Weeks and months come from the store's pre-aggregated tiers, not a daily scan.
+            period_usage_seconds = usage_seconds(self.store, self.devices, now.date() - timedelta(days=days - 1), now, period)
             
-            if not daily_usage_seconds_cumulative and not self.devices:
-                ctk.CTkLabel(self.stats_frame, text="No usage data to display. Add devices and use them.", font=("Arial", 16)).pack(pady=20)
+            if not period_usage_seconds and not self.devices:
+                self._show_stats_message("No usage data to display. Add devices and use them.")
+                self._update_stats_table(None)
+                self._update_pie(None)
                 return
 
-            today_date_obj = datetime.now().date()
-            dates_for_columns = [today_date_obj - timedelta(days=i) for i in range(6, -1, -1)]
+            today_date_obj = now.date()
+            dates_for_columns = period_dates(today_date_obj - timedelta(days=days - 1), today_date_obj, period)
             
-            all_device_names = sorted(list(set([d.name for d in self.devices] + [key[1] for key in daily_usage_seconds_cumulative.keys()])))
-
-            df = pd.DataFrame(0.0, index=all_device_names, columns=dates_for_columns)
-
-            for (date, device_name), seconds in daily_usage_seconds_cumulative.items():
-                if date in df.columns and device_name in df.index:
-                    power = device_power_map.get(device_name, 0)
-                    kwh = (power * seconds) / (1000 * 3600)
-                    df.loc[device_name, date] = kwh
+            df = usage_table(pd, period_usage_seconds, self.devices, dates_for_columns)
+            if self.devices and period == "day":
+                df.loc[[d.name for d in self.devices], today_date_obj] = [d.get_total_units() for d in self.devices]
 
-            for device in self.devices:
-                if device.name in df.index and today_date_obj in df.columns:
-                    df.loc[device.name, today_date_obj] = device.get_total_units()
-
-            column_headers = [d.strftime('%b %d') for d in df.columns[:-1]]
-            column_headers.append("Today")
+            column_headers = [d.strftime(header_format) for d in df.columns[:-1]]
+            column_headers.append(current_label)
             df.columns = column_headers
 
-            ctk.CTkLabel(self.stats_frame, text="Last 7 Days Usage (Units/kWh)", font=("Arial", 16, "bold"), text_color="#FFD369").pack(pady=(5,10))
-            style = ttk.Style()
-            style.theme_use("default")
-            style.configure("Treeview", background="#222831", foreground="#EEEEEE", fieldbackground="#222831", borderwidth=0, rowheight=25)
-            style.configure("Treeview.Heading", background="#393E46", foreground="#FFD369", font=('Arial', 11, 'bold'))
-            style.map('Treeview', background=[('selected', '#FFD369')])
-            
-            tree_frame = ctk.CTkFrame(self.stats_frame, fg_color="transparent")
-            tree_frame.pack(fill="x", padx=10)
-            
-            tree_scroll_x = ttk.Scrollbar(tree_frame, orient="horizontal")
-            tree = ttk.Treeview(tree_frame, columns=['Device'] + list(df.columns), show='headings', height=min(len(df.index), 10), xscrollcommand=tree_scroll_x.set)
-            tree_scroll_x.config(command=tree.xview)
-            tree_scroll_x.pack(side="bottom", fill="x")
-
-            tree.heading('Device', text='Device'); tree.column('Device', anchor='w', width=120)
-            for col in df.columns: 
-                tree.heading(col, text=col)
-                tree.column(col, anchor='center', width=100)
-            
-            for index, row in df.iterrows():
-                values = [index] + [f"{val:.3f}" for val in row]
-                tree.insert('', 'end', values=values)
-            tree.pack(fill="both", expand=True)
+            self._show_stats_message(None)
+            self._update_stats_table(df)
 
-            ctk.CTkLabel(self.stats_frame, text=f"Today's Consumption Distribution", font=("Arial", 16, "bold"), text_color="#FFD369").pack(pady=(20,10))
-            
             data_for_pie = df[df.columns[-1]][df[df.columns[-1]] > 0]
-            
-            pie_frame = ctk.CTkFrame(self.stats_frame, fg_color="#393E46")
-            pie_frame.pack(fill="both", expand=True, padx=10, pady=10)
-            
-            if not data_for_pie.empty:
-                fig, ax = plt.subplots(figsize=(5, 4), facecolor="#393E46")
-                ax.pie(data_for_pie, labels=data_for_pie.index, autopct='%1.1f%%', startangle=90, 
-                       textprops={'color': "w", 'fontsize': 10}, pctdistance=0.85)
-                ax.axis('equal')
-                fig.patch.set_facecolor("#393E46")
-                
-                canvas = FigureCanvasTkAgg(fig, master=pie_frame)
-                canvas.draw()
-                canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=True)
-            else:
-                ctk.CTkLabel(pie_frame, text=f"No usage recorded for Today.", font=("Arial", 14), text_color="#EEEEEE").pack(pady=20)
+            self._update_pie(data_for_pie)
 
         except Exception as e:
-            ctk.CTkLabel(self.stats_frame, text=f"An error occurred while generating stats:\n{e}", font=("Arial", 14), text_color="red").pack(pady=20)
+            self._show_stats_message(f"An error occurred while generating stats:\n{e}", error=True)
             print(f"Stats Error: {e}")
-            plt.close('all')
+
+    def _show_stats_message(self, text, error=False):
+        """Shows text in place of the usage table, or brings the table back when text is None."""
+        if text is None:
+            self.stats_message.pack_forget()
+            if not self.stats_tree_frame.winfo_manager():
+                self.stats_tree_frame.pack(fill="x", padx=10)
+            return
+        self.stats_tree_frame.pack_forget()
+        self.stats_message.configure(text=text, font=("Arial", 14 if error else 16), text_color="red" if error else ("gray10", "#DCE4EE"))
+        self.stats_message.pack(pady=20)
+
+    def _update_stats_table(self, df):
+        """Updates the usage table in place from df (devices by day, kWh), one row per device."""
+        if df is None:
+            sync_treeview(self.stats_tree, [], self.stats_rows)
+            return
+        headers = tuple(df.columns)
+        if headers != self.stats_headers:  # The dates roll over at midnight, or the window changed.
+            if self.stats_headers is None or len(headers) != len(self.stats_headers):
+                # New columns invalidate every row, so they are reinserted below.
+                sync_treeview(self.stats_tree, [], self.stats_rows)
+                columns = [f"period{i}" for i in range(len(headers))]
+                self.stats_tree.configure(columns=['Device'] + columns)
+                self.stats_tree.heading('Device', text='Device'); self.stats_tree.column('Device', anchor='w', width=120)
+                for column in columns:
+                    self.stats_tree.column(column, anchor='center', width=100)
+            for i, header in enumerate(headers):
+                self.stats_tree.heading(f"period{i}", text=header)
+            self.stats_headers = headers
+        rows = [(name, [name] + cells, ()) for name, cells in zip(df.index, format_units(df))]
+        sync_treeview(self.stats_tree, rows, self.stats_rows)
+        height = min(len(rows), 10)
+        if int(self.stats_tree.cget("height")) != height:
+            self.stats_tree.configure(height=height)
+
+    def _update_pie(self, data_for_pie):
+        """Redraws today's pie chart on the one figure and canvas the tab keeps for its lifetime."""
+        if data_for_pie is None or data_for_pie.empty:
+            if self.pie_canvas:
+                self.pie_canvas.get_tk_widget().pack_forget()
+            self.pie_empty_label.pack(pady=20)
+            return
+        self.pie_empty_label.pack_forget()
+
+        if self.pie_canvas is None:
+            _, plt, FigureCanvasTkAgg = load_charting()
+            # A bare Figure is not registered with pyplot, so nothing else can close it.
+            self.pie_figure = plt.Figure(figsize=(5, 4), facecolor="#393E46")
+            self.pie_axes = self.pie_figure.add_subplot()
+            self.pie_canvas = FigureCanvasTkAgg(self.pie_figure, master=self.pie_frame)
+        if not self.pie_canvas.get_tk_widget().winfo_manager():
+            self.pie_canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=True)
+
+        self.pie_axes.clear()
+        self.pie_axes.pie(data_for_pie, labels=data_for_pie.index, autopct='%1.1f%%', startangle=90,
+                          textprops={'color': "w", 'fontsize': 10}, pctdistance=0.85)
+        self.pie_axes.axis('equal')
+        self.pie_canvas.draw_idle()
 
     def prompt_for_api_key(self):
         """Prompts the user to enter their Google API Key and sets it as an environment variable."""
@@ -546,133 +707,121 @@ class App(ctk.CTk):
         textbox_widget.configure(state="disabled")
 
     def get_ai_recommendations(self):
-        """Fetches energy-saving recommendations from Google Gemini AI."""
-        self._apply_rich_text_formatting(self.recommendation_box, "Getting recommendations from AI... Please wait.")
-        self.update_idletasks()
+        """Starts fetching energy-saving recommendations from Google Gemini AI on a worker thread."""
+        if self.ai_job: return  # A request is already in flight.
 
         api_key = os.getenv("GOOGLE_API_KEY")
         if not api_key:
             self._apply_rich_text_formatting(self.recommendation_box, "AI recommendations unavailable: **API Key not set**. Please set your Google API Key via the prompt on app launch or restart the app to set it.")
             return
 
-        try:
-            with open(self.data_file, "r") as f: data = f.read()
-            if not data.strip(): 
-                raise FileNotFoundError
-        except FileNotFoundError:
+        if not self.devices:
             self._apply_rich_text_formatting(self.recommendation_box, "No usage data found. Please use the app (turn devices ON/OFF, save usage) to generate logs for AI analysis.")
             return
         
-        prompt = (
-            "Analyze the following device power usage log and current device states.\n"
-            "Provide 3-5 concise, actionable, bulleted recommendations to save energy. "
-            "Use **bold**, *italics*, or __underline__ formatting to highlight key terms or actions.\n\n"
-            "Log Data:\n" + data +
-            "\n\nCurrent Device States:\n" + 
-            "\n".join([f"- {d.name}: {'ON' if d.is_on else 'OFF'}, Power: {d.power}W, Total Usage: {d.get_total_units():.3f} units" for d in self.devices])
-        )
+        # Summarize the last 7 days rather than sending the raw history, so the prompt
+        # stays within recommendations.PROMPT_CHAR_BUDGET however long the journal gets.
+        now = datetime.now()
+        dates = [now.date() - timedelta(days=i) for i in range(6, -1, -1)]
+        daily_seconds = daily_usage_seconds(self.store, self.devices, dates[0], now)
+        window_start = to_timestamp(datetime.combine(dates[0], datetime.min.time()))
+        sessions = self.store.sessions_between(window_start, to_timestamp(now))
+        prompt = recommendations.build_prompt(self.devices, dates, daily_seconds, sessions)
+
+        # Unchanged usage gets the previous answer back without another model call.
+        cache_key = recommendations.fingerprint(prompt)
+        cached = self.ai_cache.get(cache_key)
+        if cached is not None:
+            self._apply_rich_text_formatting(self.recommendation_box, cached)
+            return
 
-        try:
-            genai.configure(api_key=api_key) 
-            model = genai.GenerativeModel("gemini-1.5-flash")
-            response = model.generate_content(prompt)
-            recommendations = response.text.strip()
-        except Exception as e:
-            recommendations = f"**Error fetching AI recommendations:**\n_{e}_\nEnsure your API Key is correct and you have internet access."
-        
-        self._apply_rich_text_formatting(self.recommendation_box, recommendations)
+        timeout = recommendations.DEFAULT_TIMEOUT
 
-    # --- New method for Leaderboard ---
-    def show_leaderboard(self):
-        # Clear existing widgets in stats_frame to refresh
-        for widget in self.leaderboard_tab.winfo_children():
-            widget.destroy()
+        def fetch():
+            # Importing the Gemini client takes about a second, so it happens here rather than on the Tk thread.
+            model = self._get_ai_model(api_key)
+            response = model.generate_content(prompt, request_options={"timeout": timeout})
+            return response.text.strip()
 
-        ctk.CTkLabel(self.leaderboard_tab, text="Energy Efficiency Leaderboard", font=("Arial", 20, "bold"), text_color="#FFD369").pack(pady=(10,20))
+        self._apply_rich_text_formatting(self.recommendation_box, "Getting recommendations from AI... Please wait.")
+        self.recommend_btn.configure(state="disabled")
+        self.cancel_recommend_btn.configure(state="normal")
+        self.ai_job = recommendations.RecommendationJob(fetch, timeout, key=cache_key).start()
+        self.after(100, self._poll_ai_job, self.ai_job)
+
+    def _get_ai_model(self, api_key):
+        """Returns the Gemini model, configuring the client only when the API key changes. Runs on job threads."""
+        with self.ai_model_lock:
+            if self.ai_model is None or api_key != self.ai_model_api_key:
+                genai = load_genai()
+                genai.configure(api_key=api_key)
+                self.ai_model = genai.GenerativeModel("gemini-1.5-flash")
+                self.ai_model_api_key = api_key
+            return self.ai_model
+
+    def _poll_ai_job(self, job):
+        """Checks the in-flight recommendation job from the Tk thread and shows its result when ready."""
+        if self.is_closing or job is not self.ai_job: return
+        status, payload = job.poll()
+        if status == recommendations.PENDING:
+            self.after(100, self._poll_ai_job, job)
+            return
+        if status == recommendations.DONE:
+            text = payload
+            self.ai_cache.put(job.key, text)
+        elif status == recommendations.FAILED:
+            text = f"**Error fetching AI recommendations:**\n_{payload}_\nEnsure your API Key is correct and you have internet access."
+        elif status == recommendations.TIMED_OUT:
+            text = "**AI recommendations timed out.** Check your internet connection and try again."
+        else:
+            text = "AI recommendation request cancelled."
+        self._finish_ai_job(text)
+
+    def cancel_ai_recommendations(self):
+        if self.ai_job:
+            self.ai_job.cancel()
+            self._finish_ai_job("AI recommendation request cancelled.")
 
+    def _finish_ai_job(self, text):
+        self.ai_job = None
+        self.recommend_btn.configure(state="normal")
+        self.cancel_recommend_btn.configure(state="disabled")
+        self._apply_rich_text_formatting(self.recommendation_box, text)
+
+    # --- New method for Leaderboard ---
+    def show_leaderboard(self):
         leaderboard_data = []
         
         # Calculate current user's total usage (saved + session) for their own ranking
-        current_user_total_usage = 0
-        for device in self.devices:
-            current_user_total_usage += device.get_total_units()
+        current_user_total_usage = self.devices.total_units()
         
-        # Scan for all user data files in the current directory
-        for filename in os.listdir('.'): 
-            if filename.endswith("_data.txt"):
-                try:
-                    username_from_file = filename.replace("_data.txt", "")
-                    total_usage_from_file = 0.0
-                    
-                    with open(filename, "r") as f:
-                        lines = f.readlines()
-                    
-                    in_devices_section = False
-                    for line in lines:
-                        stripped = line.strip()
-                        if not stripped: continue
-                        if stripped == "## DEVICES ##":
-                            in_devices_section = True
-                            continue
-                        if stripped == "## LOGS ##": # Stop at logs section
-                            in_devices_section = False
-                            break # No need to read logs for total usage from devices section
-                        
-                        if in_devices_section:
-                            try:
-                                # Example line: "DeviceName (100W) | 12.345"
-                                # We only need the usage part
-                                info_part, usage_part = stripped.split(" | ")
-                                saved_usage = float(usage_part)
-                                total_usage_from_file += saved_usage
-                            except Exception as e:
-                                print(f"Error parsing device line in {filename}: '{stripped}' - {e}")
-                                continue # Skip this line, try next one
-                    
-                    # For the current user, use their real-time total usage (saved + session)
-                    if username_from_file == self.username:
-                        final_user_usage = current_user_total_usage
-                    else:
-                        # For other users, use the total_usage_from_file which reflects their last saved state
-                        final_user_usage = total_usage_from_file
-
-                    leaderboard_data.append({'username': username_from_file, 'total_usage': final_user_usage})
-
-                except Exception as e:
-                    print(f"Could not read data from file {filename}: {e}")
-                    continue
+        # Saved totals come from the leaderboard index (only data files that changed since
+        # they were indexed get reparsed) or from one aggregate query in SQLite mode.
+        saved_totals = self.store.leaderboard_totals()
+        for username_from_file, total_usage_from_file in saved_totals.items():
+            # For the current user, use their real-time total usage (saved + session)
+            if username_from_file == self.username:
+                final_user_usage = current_user_total_usage
+            else:
+                # For other users, use the total_usage_from_file which reflects their last saved state
+                final_user_usage = total_usage_from_file
+
+            leaderboard_data.append({'username': username_from_file, 'total_usage': final_user_usage})
 
         if not leaderboard_data:
-            ctk.CTkLabel(self.leaderboard_tab, text="No users found for leaderboard. Create more user data files.", font=("Arial", 16)).pack(pady=20)
+            sync_treeview(self.leaderboard_tree, [], self.leaderboard_rows)
+            self.leaderboard_tree_frame.pack_forget()
+            self.leaderboard_message.pack(pady=20, before=self.leaderboard_note)
             return
+        if not self.leaderboard_tree_frame.winfo_manager():
+            self.leaderboard_message.pack_forget()
+            self.leaderboard_tree_frame.pack(fill="both", expand=True, padx=10, before=self.leaderboard_note)
 
         # Sort by total_usage in ascending order (least usage at top)
         leaderboard_data.sort(key=lambda x: x['total_usage'])
 
-        # Setup Treeview for leaderboard display
-        style = ttk.Style()
-        style.theme_use("default") # Important to reset theme for custom styling
-        style.configure("Treeview", background="#222831", foreground="#EEEEEE", fieldbackground="#222831", borderwidth=0, rowheight=35) # Increased rowheight for medal/bigger font
-        style.configure("Treeview.Heading", background="#393E46", foreground="#FFD369", font=('Arial', 12, 'bold'))
-        style.map('Treeview', background=[('selected', '#FFD369')]) # Selection color
-        
-        tree_frame = ctk.CTkFrame(self.leaderboard_tab, fg_color="transparent")
-        tree_frame.pack(fill="both", expand=True, padx=10)
-
-        columns = ['Rank', 'User', 'Total_Usage']
-        tree = ttk.Treeview(tree_frame, columns=columns, show='headings', height=min(len(leaderboard_data), 10)) # Limit height to 10 rows or actual data size
-        
-        # Configure column headings and widths
-        tree.heading('Rank', text='Rank'); tree.column('Rank', anchor='center', width=60)
-        tree.heading('User', text='User'); tree.column('User', anchor='w', width=200) # Left-align User names
-        tree.heading('Total_Usage', text='Total Usage (Units)'); tree.column('Total_Usage', anchor='center', width=150)
-        
-        # Define tags for special formatting
-        # You can adjust the font size for 'top_rank_bold' here (e.g., 18 or 20)
-        tree.tag_configure('top_rank_bold', font=('Arial', 18, 'bold'), foreground='#FFD369') # Bigger font and highlight color
-        tree.tag_configure('current_user_highlight', background='#5cb85c', foreground='#FFFFFF') # Highlight current user with green
-
-        # Populate Treeview
+        # Rows are keyed by username, so only users whose rank or total changed are redrawn.
+        rows = []
         for i, entry in enumerate(leaderboard_data):
             rank = i + 1
             user_name = entry['username']
@@ -691,12 +840,12 @@ class App(ctk.CTk):
             if user_name == self.username:
                 tags.append('current_user_highlight') 
             
-            tree.insert('', 'end', values=(rank, display_user_name, total_usage), tags=tuple(tags)) # Insert with combined tags
-
-        tree.pack(fill="both", expand=True)
+            rows.append((user_name, (rank, display_user_name, total_usage), tags))
 
-        ctk.CTkLabel(self.leaderboard_tab, text="*Total Usage includes all saved and current session units for all users.", font=("Arial", 10), text_color="#EEEEEE").pack(pady=(5,0))
-        ctk.CTkLabel(self.leaderboard_tab, text="**Leaderboard updates based on last saved state of each user.", font=("Arial", 10), text_color="#EEEEEE").pack(pady=(0,5))
+        sync_treeview(self.leaderboard_tree, rows, self.leaderboard_rows)
+        height = min(len(rows), 10) # Limit height to 10 rows or actual data size
+        if int(self.leaderboard_tree.cget("height")) != height:
+            self.leaderboard_tree.configure(height=height)
 
 
 # --- Main Application Execution ---
@@ -709,7 +858,11 @@ if __name__ == "__main__":
     root_for_dialog.destroy() # Destroy the temporary root window
 
     if username:
-        app = App(username)
+        try:
+            app = App(username)
+        except (UserLockedError, MeterError) as e:
+            messagebox.showerror("WattWise", f"Could not open {username}'s data:\n{e}")
+            sys.exit(1)
         app.mainloop()
     else:
         # If user cancels username prompt, exit gracefully
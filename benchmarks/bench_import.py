@@ -0,0 +1,73 @@
+"""Bulk import throughput.
+
+    python benchmarks/bench_import.py [--rows 2000000] [--devices 200] [--backends journal,sqlite,text]
+
+Generates --rows ON/OFF events as CSV and, when pyarrow is installed, Parquet, then
+times importer.import_history into a fresh user on each backend and reports rows per
+minute. Runs in a temporary directory.
+"""
+import argparse
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from importer import DEFAULT_CHUNK_SIZE, import_history
+from storage import open_store
+
+
+def make_frame(rows, devices):
+    """Returns a DataFrame of rows alternating ON/OFF events, one minute apart, ending now."""
+    import pandas as pd
+    end = pd.Timestamp.now().floor("s")
+    timestamps = end - pd.to_timedelta((rows - 1 - np.arange(rows)) * 60, unit="s")
+    device_indexes = (np.arange(rows) // 2) % devices
+    return pd.DataFrame({
+        "timestamp": timestamps,
+        "device": np.char.add("Device ", device_indexes.astype(str)),
+        "state": np.where(np.arange(rows) % 2 == 0, "ON", "OFF"),
+        "power": 100.0 + device_indexes,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time bulk imports on each storage backend")
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--devices", type=int, default=200)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--backends", default="journal,sqlite,text")
+    options = parser.parse_args()
+
+    frame = make_frame(options.rows, options.devices)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            files = ["events.csv"]
+            frame.to_csv("events.csv", index=False)
+            if importlib.util.find_spec("pyarrow"):
+                frame.to_parquet("events.parquet", index=False)
+                files.append("events.parquet")
+            for path in files:
+                print(f"{path}: {options.rows:,} rows, {os.path.getsize(path) / 1e6:.1f} MB")
+                for kind in options.backends.split(","):
+                    username = f"bench_{kind}_{os.path.splitext(path)[1][1:]}"
+                    store = open_store(username, kind)
+                    try:
+                        started = time.perf_counter()
+                        rows = import_history(username, path, chunk_size=options.chunk_size, store=store)
+                        elapsed = time.perf_counter() - started
+                    finally:
+                        store.close()
+                    print(f"  {kind:8} {elapsed:7.2f} s  {rows / elapsed * 60:>14,.0f} rows/min")
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Stats pie chart latency, per tab visit.
+
+    python benchmarks/bench_pie.py [--devices 12] [--visits 20]
+
+Times App._update_pie against a hidden Tk root, for the first call (which creates the
+figure, axes and canvas) and for repeat calls (which redraw the kept figure), each until
+Tk is idle again. It also times the old per-visit rebuild (close every figure, destroy
+the canvas, create a new figure and FigureCanvasTkAgg) for comparison. Needs a display;
+exits without timing anything when there is none.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tkinter as tk
+
+import customtkinter as ctk
+
+
+def pie_data(devices, visit):
+    import pandas as pd
+    values = [(i + visit) % devices + 1.0 for i in range(devices)]
+    return pd.Series(values, index=[f"Device {i}" for i in range(devices)])
+
+
+def pie_view(root):
+    """The attributes App._update_pie uses, as App.setup_stats_tab builds them."""
+    frame = ctk.CTkFrame(root, fg_color="#393E46")
+    frame.pack(fill="both", expand=True)
+    empty_label = ctk.CTkLabel(frame, text="No usage recorded for Today.")
+    return SimpleNamespace(pie_frame=frame, pie_empty_label=empty_label, pie_figure=None, pie_axes=None, pie_canvas=None)
+
+
+def timed(root, function):
+    started = time.perf_counter()
+    function()
+    root.update()  # Includes the draw draw_idle scheduled.
+    return time.perf_counter() - started
+
+
+def rebuild(view, data):
+    """The pie as show_stats drew it before the figure was kept: everything new on each visit."""
+    from App import load_charting
+    _, plt, FigureCanvasTkAgg = load_charting()
+    plt.close("all")
+    for widget in view.pie_frame.winfo_children():
+        widget.destroy()
+    figure, axes = plt.subplots(figsize=(5, 4), facecolor="#393E46")
+    axes.pie(data, labels=data.index, autopct='%1.1f%%', startangle=90,
+             textprops={'color': "w", 'fontsize': 10}, pctdistance=0.85)
+    axes.axis('equal')
+    canvas = FigureCanvasTkAgg(figure, master=view.pie_frame)
+    canvas.draw()
+    canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time Stats pie chart updates")
+    parser.add_argument("--devices", type=int, default=12)
+    parser.add_argument("--visits", type=int, default=20)
+    options = parser.parse_args()
+
+    try:
+        root = ctk.CTk()
+    except tk.TclError as e:
+        print(f"Skipped: no display available ({e}).")
+        return
+    root.withdraw()
+    from App import App, load_charting
+    load_charting()  # Import time is startup's concern (tests/test_startup.py), not the tab's.
+
+    view = pie_view(root)
+    first = timed(root, lambda: App._update_pie(view, pie_data(options.devices, 0)))
+    repeats = [timed(root, lambda: App._update_pie(view, pie_data(options.devices, visit)))
+               for visit in range(1, options.visits + 1)]
+    print(f"_update_pie, first call:   {first * 1000:7.1f} ms")
+    print(f"_update_pie, repeat calls: {statistics.median(repeats) * 1000:7.1f} ms (median of {options.visits})")
+
+    old_view = pie_view(root)
+    rebuilds = [timed(root, lambda: rebuild(old_view, pie_data(options.devices, visit)))
+                for visit in range(options.visits)]
+    print(f"per-visit rebuild:         {statistics.median(rebuilds) * 1000:7.1f} ms (median of {options.visits})")
+    root.destroy()
+
+
+if __name__ == "__main__":
+    main()
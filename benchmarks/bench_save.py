@@ -0,0 +1,100 @@
+"""Save latency on a large history.
+
+    python benchmarks/bench_save.py [--lines 1000000] [--devices 50] [--repeat 5]
+
+Writes a text-format data file with --lines log lines, then times write_data_file
+(the text backend's save: an atomic rewrite carrying the LOGS section over) with and
+without rotating backups, and JournalStore.save_devices on the same history, whose
+save only rewrites the device snapshot. Runs in a temporary directory.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+import datafile
+from datafile import DEVICES_HEADER, LOGS_HEADER, read_data_file, write_data_file
+from journal import EVENT_ON, EVENT_OFF, format_log_line
+from meter import DeviceRegistry
+from storage import JournalStore
+
+START_TS = 1_600_000_000
+
+
+def make_history(lines, devices):
+    """Returns ([(name, power, saved units)], ts, device indexes, events) for lines ON/OFF events."""
+    rows = [(f"Device {i}", 100.0 + i, 0.0) for i in range(devices)]
+    ts = START_TS + np.arange(lines, dtype=np.int64) * 60
+    device_indexes = (np.arange(lines) // 2) % devices
+    events = np.where(np.arange(lines) % 2 == 0, EVENT_ON, EVENT_OFF).astype(np.uint8)
+    return rows, ts, device_indexes, events
+
+
+def time_calls(function, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+
+def bench_text(rows, ts, device_indexes, events, repeat):
+    path = "bench_data.txt"
+    with open(path, "w") as f:
+        f.write(DEVICES_HEADER + "\n")
+        for name, power, saved in rows:
+            f.write(f"{name} ({power}W) | {saved}\n")
+        f.write("\n" + LOGS_HEADER + "\n")
+        for t, i, event in zip(ts.tolist(), device_indexes.tolist(), events.tolist()):
+            f.write(format_log_line(t, rows[i][0], event) + "\n")
+    print(f"text data file: {len(ts):,} log lines, {os.path.getsize(path) / 1e6:.1f} MB")
+    for backups in (0, 3):
+        datafile.BACKUP_COUNT = backups
+        seconds = time_calls(lambda: write_data_file(path, rows, keep_logs_from=read_data_file(path)), repeat)
+        print(f"  write_data_file, {backups} backups: {seconds * 1000:8.1f} ms (median of {repeat})")
+    datafile.BACKUP_COUNT = 0
+
+
+def bench_journal(rows, ts, device_indexes, events, repeat):
+    store = JournalStore("bench")
+    try:
+        names = np.array([name for name, _, _ in rows])
+        store.append_bulk(ts, names[device_indexes], events)
+        devices = DeviceRegistry()
+        for name, power, _ in rows:
+            devices.add(name, power)
+        print(f"journal: {len(ts):,} events, {os.path.getsize(store.journal.path) / 1e6:.1f} MB")
+        store.save_devices(devices)  # The first save archives the months older than the hot window.
+        seconds = time_calls(lambda: store.save_devices(devices), repeat)
+        print(f"  JournalStore.save_devices:  {seconds * 1000:8.1f} ms (median of {repeat})")
+    finally:
+        store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time saves on a large history")
+    parser.add_argument("--lines", type=int, default=1_000_000)
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    options = parser.parse_args()
+
+    history = make_history(options.lines, options.devices)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            bench_text(*history, options.repeat)
+            bench_journal(*history, options.repeat)
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Stats table construction: per-cell df.loc writes versus one pivot.
+
+    python benchmarks/bench_stats_table.py [--devices 10000] [--days 30] [--density 0.8]
+
+Builds the Stats tab's kWh table and its display strings from a {(date, device): seconds}
+map, first the way show_stats used to (a zero DataFrame filled one df.loc cell at a time,
+then formatted per cell), then with App.usage_table and App.format_units. Checks that
+both give the same strings and prints the time of each step. Needs no display.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from App import format_units, load_charting, usage_table
+from meter import DeviceRegistry
+
+
+def make_usage(devices, days, density, seed=1):
+    random.seed(seed)
+    registry = DeviceRegistry()
+    for i in range(devices):
+        registry.add(f"Device {i:05d}", float(random.randint(5, 3000)))
+    today = date.today()
+    dates = [today - timedelta(days=i) for i in range(days - 1, -1, -1)]
+    usage = {(day, device.name): random.uniform(60, 86400)
+             for device in registry for day in dates if random.random() < density}
+    return registry, dates, usage
+
+
+def per_cell_table(pd, usage_seconds, devices, dates):
+    """show_stats before the pivot: one df.loc write per cell, then one f-string per value."""
+    device_power_map = {d.name: d.power for d in devices}
+    all_device_names = sorted(set([d.name for d in devices] + [key[1] for key in usage_seconds.keys()]))
+    df = pd.DataFrame(0.0, index=all_device_names, columns=dates)
+    for (day, device_name), seconds in usage_seconds.items():
+        if day in df.columns and device_name in df.index:
+            df.loc[device_name, day] = (device_power_map.get(device_name, 0) * seconds) / (1000 * 3600)
+    return df, [[f"{val:.3f}" for val in row] for row in df.to_numpy()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the Stats table build")
+    parser.add_argument("--devices", type=int, default=10_000)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--density", type=float, default=0.8, help="share of (day, device) cells with usage")
+    parser.add_argument("--skip-old", action="store_true", help="only time the pivot (the per-cell build takes ~20 s)")
+    options = parser.parse_args()
+
+    pd, _, _ = load_charting()
+    devices, dates, usage = make_usage(options.devices, options.days, options.density)
+    print(f"{options.devices:,} devices x {options.days} days, {len(usage):,} non-zero cells")
+
+    started = time.perf_counter()
+    table = usage_table(pd, usage, devices, dates)
+    built = time.perf_counter()
+    cells = format_units(table)
+    formatted = time.perf_counter()
+    print(f"usage_table + format_units: {formatted - started:7.2f} s "
+          f"(table {built - started:.2f} s, formatting {formatted - built:.2f} s)")
+
+    if not options.skip_old:
+        started = time.perf_counter()
+        _, old_cells = per_cell_table(pd, usage, devices, dates)
+        print(f"per-cell df.loc build:      {time.perf_counter() - started:7.2f} s")
+        print("display strings identical:", old_cells == cells)
+
+
+if __name__ == "__main__":
+    main()
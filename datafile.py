@@ -0,0 +1,175 @@
+import os
+import shutil
+
+from journal import parse_log_line, format_log_line, to_timestamp
+
+DEVICES_HEADER = "## DEVICES ##"
+LOGS_HEADER = "## LOGS ##"
+
+# Number of previous data file versions kept as '<file>.1' (newest) ... '<file>.N'.
+BACKUP_COUNT = int(os.getenv("WATTWISE_BACKUPS", "0"))
+
+# path -> (mtime_ns, size, DataFile); one parse per file version serves every reader.
+_cache = {}
+
+
+def parse_device_line(stripped):
+    """Parses 'Name (100.0W) | 12.345' into (name, power, saved units)."""
+    info_part, usage_part = stripped.split(" | ")
+    name_part, power_part = info_part.split(" (")
+    return name_part.strip(), float(power_part.split("W)")[0]), float(usage_part)
+
+
+class DataFile:
+    """Parsed contents of a '{username}_data.txt' file."""
+    def __init__(self, devices, log_lines, has_logs_section):
+        self.devices = devices        # [(name, power, saved units)]
+        self.log_lines = log_lines    # raw lines of the '## LOGS ##' section, if any
+        self.has_logs_section = has_logs_section
+        self._events = None
+
+    @property
+    def events(self):
+        """The log section parsed into time-ordered (timestamp, device name, event) tuples."""
+        if self._events is None:
+            parsed = [event for event in map(parse_log_line, self.log_lines) if event]
+            parsed.sort(key=lambda e: e[0])
+            self._events = [(to_timestamp(dt), name, event) for dt, name, event in parsed]
+        return self._events
+
+    @property
+    def saved_total(self):
+        return sum(saved for _, _, saved in self.devices)
+
+
+def _signature(stat):
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _rotate_backups(path, count):
+    for n in range(count - 1, 0, -1):
+        if os.path.exists(f"{path}.{n}"):
+            os.replace(f"{path}.{n}", f"{path}.{n + 1}")
+    if os.path.exists(f"{path}.1"):
+        os.remove(f"{path}.1")
+    try:
+        os.link(path, f"{path}.1")  # The old version is about to be replaced, so a hard link is enough.
+    except OSError:
+        shutil.copy2(path, f"{path}.1")
+
+
+def atomic_write(path, write, backups=0):
+    """Replaces path with the contents write(f) produces, so readers and crashes only ever see a whole file.
+
+    The new version is written to a temp file in the same directory, fsync'd and renamed
+    over the old one. With backups > 0 the previous versions are rotated first.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        if backups and os.path.exists(path):
+            _rotate_backups(path, backups)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    # Persist the rename itself; directories cannot be opened for fsync on Windows.
+    if hasattr(os, "O_DIRECTORY"):
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def read_data_file(path):
+    """Returns the parsed DataFile for path, or None if it does not exist. Results are cached per file version."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    cached = _cache.get(path)
+    if cached and cached[0] == _signature(stat):
+        return cached[1]
+
+    with open(path, "r") as f: lines = f.readlines()
+    devices, log_lines = [], []
+    in_devices_section = has_logs_section = False
+    for line_number, line in enumerate(lines):
+        stripped = line.strip()
+        if not stripped: continue
+        if stripped == DEVICES_HEADER: in_devices_section = True; continue
+        if stripped == LOGS_HEADER:
+            has_logs_section = True
+            log_lines = [l for l in lines[line_number + 1:] if l.strip()]
+            break
+        if in_devices_section:
+            try:
+                devices.append(parse_device_line(stripped))
+            except Exception as e:
+                print(f"Failed to load device line: '{stripped}' - Error: {e}")
+    data = DataFile(devices, log_lines, has_logs_section)
+    _cache[path] = (_signature(stat), data)
+    return data
+
+
+def write_data_file(path, devices, keep_logs_from=None):
+    """Rewrites the data file from (name, power, saved units) rows and refreshes the cache.
+
+    Passing the previous DataFile as keep_logs_from carries its LOGS section (and its
+    parsed events) over to the new version.
+    """
+    log_lines = keep_logs_from.log_lines if keep_logs_from else []
+    def write(f):
+        f.write(DEVICES_HEADER + "\n")
+        for name, power, saved_units in devices:
+            f.write(f"{name} ({power}W) | {saved_units}\n")
+        if log_lines:
+            f.write("\n" + LOGS_HEADER + "\n")
+            f.writelines(log_lines)
+    atomic_write(path, write, BACKUP_COUNT)
+    data = DataFile(list(devices), log_lines, bool(log_lines))
+    if keep_logs_from:
+        data._events = keep_logs_from._events
+    _cache[path] = (_signature(os.stat(path)), data)
+    return data
+
+
+def append_log_events(path, events):
+    """Appends (datetime, device name, event) tuples to the '## LOGS ##' section in place.
+
+    The cached parse is extended rather than invalidated, so readers never reparse the
+    history just because new events were written.
+    """
+    events = list(events)
+    data = read_data_file(path) or DataFile([], [], False)
+    lines = [format_log_line(to_timestamp(dt), name, event) + "\n" for dt, name, event in events]
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    try:
+        with open(path, "a") as f:
+            if not data.has_logs_section:
+                f.write("\n" + LOGS_HEADER + "\n")
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+    except OSError:
+        # Cut off a partial write so retrying the batch does not duplicate lines.
+        with open(path, "r+b") as f:
+            f.truncate(size)
+        raise
+    data.has_logs_section = True
+    data.log_lines.extend(lines)
+    if data._events is not None:
+        data._events.extend((to_timestamp(dt), name, event) for dt, name, event in events)
+    _cache[path] = (_signature(os.stat(path)), data)
+
+
+def forget_parsed_events(path):
+    """Drops the cached parse of path's events, e.g. after lines were appended out of time order."""
+    cached = _cache.get(path)
+    if cached:
+        cached[1]._events = None
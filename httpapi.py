@@ -0,0 +1,217 @@
+"""Read-mostly HTTP/JSON API served by meterd for dashboards and scripts.
+
+User resources exist for users a GUI has attached to the daemon (WATTWISE_DAEMON);
+the leaderboard covers every user.
+
+    GET  /users/<user>/devices                 devices with live total_units, plus the user's total
+    POST /users/<user>/devices/<name>/toggle   toggles a device, returns the devices
+    GET  /users/<user>/stats?days=7            per-device kWh for each of the last N days
+    GET  /leaderboard                          every user's total units, lowest first
+    GET  /users/<user>/stream                  Server-Sent Events: a snapshot, then only deltas
+
+Every GET response carries an ETag; a request with a matching If-None-Match gets an
+empty 304. Aggregates are cached until the underlying data changes, or for at most
+CACHE_SECONDS while devices are running, so many dashboards polling at once cost
+about as much as one.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from livefeed import LiveFeed
+
+# Upper bound on how stale a cached aggregate may get while its devices are running.
+CACHE_SECONDS = float(os.getenv("WATTWISE_HTTP_CACHE_SECONDS", "5"))
+MAX_STATS_DAYS = 366
+# Idle streams get a comment line this often so proxies and clients keep them open.
+KEEPALIVE_SECONDS = 15
+
+_DEVICES = re.compile(r"^/users/([^/]+)/devices/?$")
+_TOGGLE = re.compile(r"^/users/([^/]+)/devices/([^/]+)/toggle/?$")
+_STATS = re.compile(r"^/users/([^/]+)/stats/?$")
+_STREAM = re.compile(r"^/users/([^/]+)/stream/?$")
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _kwh(power, seconds):
+    return (power * seconds) / (1000 * 3600)
+
+
+class ResponseCache:
+    """Encoded responses keyed by URL, valid while their token matches and they have not expired."""
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, token, compute, ttl=None):
+        """Returns (body, etag) for key, calling compute() only when the cached copy is stale."""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] == token and now < entry[1]:
+                return entry[2], entry[3]
+        body = json.dumps(compute()).encode("utf-8")
+        etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+        with self.lock:
+            self.entries[key] = (token, now + ttl if ttl is not None else float("inf"), body, etag)
+        return body, etag
+
+
+class ApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        super().__init__(address, _ApiHandler)
+        self.service = service
+        self.cache = ResponseCache()
+        self.feed = LiveFeed(service)
+
+    # --- Resources ---
+
+    def _user(self, username):
+        # Only users the daemon owns are served; anyone else may be open in a GUI that
+        # is writing their data right now.
+        if not self.service.has_user(username):
+            raise HTTPError(404, f"User '{username}' is not attached to this daemon")
+        return username
+
+    def devices(self, username):
+        devices, _ = self.service.device_snapshot(self._user(username))
+        for device in devices:
+            device["total_units"] = round(device["total_units"], 3)
+        return {"user": username, "devices": devices,
+                "total_units": round(sum(d["total_units"] for d in devices), 3)}
+
+    def devices_response(self, username):
+        # Cheap enough to build per request; the ETag only changes when a rounded value does.
+        body = json.dumps(self.devices(username)).encode("utf-8")
+        return body, '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+
+    def toggle(self, username, name):
+        try:
+            self.service.handle({"op": "toggle", "user": self._user(username), "args": {"name": name}})
+        except KeyError:
+            raise HTTPError(404, f"Unknown device '{name}'")
+        return self.devices(username)
+
+    def stats_response(self, username, days):
+        username = self._user(username)
+        today = datetime.now().date()
+        running = self.service.device_snapshot(username)[1]
+
+        def compute():
+            dates = [today - timedelta(days=i) for i in range(days - 1, -1, -1)]
+            usage, power = self.service.daily_usage(username, dates[0])
+            return {
+                "user": username,
+                "dates": [d.isoformat() for d in dates],
+                "devices": {name: [round(_kwh(watts, usage.get((d, name), 0)), 4) for d in dates]
+                            for name, watts in power.items()},
+            }
+        token = (self.service.version(username), today)
+        return self.cache.get(("stats", username, days), token, compute, CACHE_SECONDS if running else None)
+
+    def leaderboard_response(self):
+        def compute():
+            totals = self.service.leaderboard_totals()
+            return {"users": [{"user": user, "total_units": round(total, 3)}
+                              for user, total in sorted(totals.items(), key=lambda item: item[1])]}
+        # Loaded users with running devices change continuously, so bound the staleness.
+        return self.cache.get(("leaderboard",), self.service.leaderboard_signature(), compute, CACHE_SECONDS)
+
+
+class _ApiHandler(BaseHTTPRequestHandler):
+    server_version = "WattWise"
+
+    def log_message(self, format, *args):
+        pass  # Dashboards poll constantly; don't flood the daemon's output.
+
+    def _send(self, status, body=b"", etag=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if etag:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, error):
+        self._send(error.status, json.dumps({"error": str(error)}).encode("utf-8"))
+
+    def _write_event(self, event):
+        self.wfile.write(f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode("utf-8"))
+
+    def _stream(self, username):
+        feed = self.server.feed
+        subscription = feed.subscribe(username)
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            while True:
+                work = subscription.next(KEEPALIVE_SECONDS)
+                if work is None:
+                    self.wfile.write(b": keepalive\n\n")
+                elif work == "snapshot":
+                    self._write_event(feed.snapshot(username))
+                else:
+                    for event in work:
+                        self._write_event(event)
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The client went away.
+        finally:
+            feed.unsubscribe(subscription)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        stream = _STREAM.match(url.path)
+        if stream:
+            try:
+                username = self.server._user(unquote(stream.group(1)))
+            except HTTPError as e:
+                return self._send_error(e)
+            return self._stream(username)
+        try:
+            if url.path.rstrip("/") == "/leaderboard":
+                body, etag = self.server.leaderboard_response()
+            elif _DEVICES.match(url.path):
+                body, etag = self.server.devices_response(unquote(_DEVICES.match(url.path).group(1)))
+            elif _STATS.match(url.path):
+                try:
+                    days = int(parse_qs(url.query).get("days", ["7"])[0])
+                except ValueError:
+                    raise HTTPError(400, "days must be an integer")
+                if not 1 <= days <= MAX_STATS_DAYS:
+                    raise HTTPError(400, f"days must be between 1 and {MAX_STATS_DAYS}")
+                body, etag = self.server.stats_response(unquote(_STATS.match(url.path).group(1)), days)
+            else:
+                raise HTTPError(404, f"No resource at {url.path}")
+        except HTTPError as e:
+            return self._send_error(e)
+        if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+            return self._send(304, etag=etag)
+        self._send(200, body, etag)
+
+    def do_POST(self):
+        match = _TOGGLE.match(urlsplit(self.path).path)
+        try:
+            if not match:
+                raise HTTPError(404, f"No resource at {self.path}")
+            result = self.server.toggle(unquote(match.group(1)), unquote(match.group(2)))
+        except HTTPError as e:
+            return self._send_error(e)
+        self._send(200, json.dumps(result).encode("utf-8"))
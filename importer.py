@@ -0,0 +1,205 @@
+"""Bulk import of historical meter readings into a user's WattWise storage.
+
+    python importer.py USERNAME events.csv [--devices devices.csv] [--chunk-size 200000]
+
+Event files are CSV or Parquet with one row per state change:
+
+    timestamp            ISO date/time (naive local time, or with an offset to convert)
+    device               device name
+    state                ON/OFF, 1/0 or true/false
+    power                optional; watts, used to define devices not seen before
+
+Device files (CSV or Parquet) have `device` and `power` columns. Rows are read and written
+in chunks, so memory use is bounded by --chunk-size rather than the file size. Events
+must be in time order. Rows newer than the user's existing history are appended; older
+rows are backfilled. The SQLite and text backends accept them anywhere, the journal only
+before its first recorded event. The app and meterd must not own the user during the import.
+"""
+import argparse
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+from journal import EVENT_ON, EVENT_OFF
+from meter import Meter
+from rollup import day_date
+from storage import open_store, UserLockedError
+
+DEFAULT_CHUNK_SIZE = 200_000
+_ON_STATES = {"ON", "1", "TRUE", "YES"}
+
+
+def iter_chunks(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields pandas DataFrames of at most chunk_size rows from a CSV or Parquet file."""
+    if path.lower().endswith((".parquet", ".pq")):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("Reading Parquet files requires pyarrow: pip install pyarrow")
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        import pandas as pd
+        yield from pd.read_csv(path, chunksize=chunk_size, dtype={"device": str, "state": str})
+
+
+def _journal_seconds(column):
+    """Converts a timestamp column to journal seconds (naive local wall-clock time)."""
+    import pandas as pd
+    from dateutil.tz import tzlocal  # Installed with pandas.
+    stamps = pd.to_datetime(column)
+    if stamps.dt.tz is not None:
+        # The local zone's rules, not today's offset, so DST is right across a multi-year history.
+        stamps = stamps.dt.tz_convert(tzlocal()).dt.tz_localize(None)
+    return stamps.to_numpy(dtype="datetime64[s]").astype(np.int64)
+
+
+def _event_types(column):
+    states = column.astype(str).str.strip().str.upper()
+    return np.where(states.isin(_ON_STATES).to_numpy(), EVENT_ON, EVENT_OFF).astype(np.uint8)
+
+
+class Importer:
+    """Streams event chunks into a store, tracking new devices and the imported time span.
+
+    Rows newer than the store's newest event are appended. Older rows go through
+    insert_bulk, and finish_inserts() folds them into the store's rollups before the first
+    newer row is appended.
+    """
+    def __init__(self, store, powers=None):
+        self.store = store
+        self.powers = dict(powers or {})
+        self.rows = 0
+        self.last_ts = None
+        self.history_end = store.last_timestamp()
+        self.inserted_last = {}  # device name -> type of its newest backfilled event not yet finished
+        self.inserted_end = None
+
+    def add_chunk(self, frame):
+        timestamps = _journal_seconds(frame["timestamp"])
+        order = np.argsort(timestamps, kind="stable")
+        timestamps = timestamps[order]
+        if self.last_ts is not None and len(timestamps) and timestamps[0] < self.last_ts:
+            raise ValueError(f"Events must be in time order; row {self.rows + int(order[0]) + 1} goes back in time.")
+        device_names = frame["device"].astype(str).to_numpy()[order]
+        events = _event_types(frame["state"])[order]
+        if "power" in frame:
+            for name, power in frame[["device", "power"]].drop_duplicates("device").itertuples(index=False):
+                self.powers.setdefault(str(name), float(power))
+
+        older = 0 if self.history_end is None else int(np.searchsorted(timestamps, self.history_end))
+        if older:
+            self.store.insert_bulk(timestamps[:older], device_names[:older], events[:older])
+            names, last = np.unique(device_names[:older][::-1], return_index=True)
+            self.inserted_last.update(zip(names.tolist(), events[:older][::-1][last].tolist()))
+            self.inserted_end = int(timestamps[older - 1])
+        if older < len(timestamps):
+            self.finish_inserts()
+            self.store.append_bulk(timestamps[older:], device_names[older:], events[older:])
+        if len(timestamps):
+            self.last_ts = timestamps[-1]
+        self.rows += len(timestamps)
+
+    def finish_inserts(self):
+        """Ends the sessions the backfilled rows leave open with them and lets the store fold the rows in."""
+        if not self.inserted_last: return
+        still_open = sorted(name for name, event in self.inserted_last.items() if event == EVENT_ON)
+        if still_open:
+            self.store.insert_bulk(np.full(len(still_open), self.inserted_end, dtype=np.int64), np.array(still_open),
+                                   np.full(len(still_open), EVENT_OFF, dtype=np.uint8))
+        self.store.finish_inserts()
+        self.inserted_last = {}
+
+
+def load_device_powers(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    powers = {}
+    for frame in iter_chunks(path, chunk_size):
+        for name, power in frame[["device", "power"]].itertuples(index=False):
+            powers[str(name)] = float(power)
+    return powers
+
+
+def import_history(username, events_path, devices_path=None, chunk_size=DEFAULT_CHUNK_SIZE, store=None):
+    """Imports a history file for username and returns the number of events written.
+
+    Imported usage is added to each device's saved total so the leaderboard covers it;
+    devices that are new to the user are created with their imported power rating.
+    """
+    if store is None:
+        store = open_store(username)
+        try:
+            return import_history(username, events_path, devices_path, chunk_size, store)
+        finally:
+            store.close()
+    meter = Meter(username, store)
+    meter.load()
+    existing = {device.name for device in meter.devices}
+
+    importer = Importer(store, load_device_powers(devices_path, chunk_size) if devices_path else None)
+    first_date = None
+    before, open_before = {}, store.open_sessions()
+    for frame in iter_chunks(events_path, chunk_size):
+        if first_date is None and len(frame):
+            # Usage already recorded in the imported span is subtracted below.
+            first_date = day_date(int(_journal_seconds(frame["timestamp"]).min()) // 86400)
+            before = store.usage_between(first_date, datetime.now().date())
+        importer.add_chunk(frame)
+    importer.finish_inserts()
+    if not importer.rows:
+        return 0
+
+    # The app starts every device OFF, so sessions the export leaves open end with it.
+    still_open = sorted(name for name in store.open_sessions() if name not in open_before)
+    if still_open:
+        store.append_bulk(np.full(len(still_open), importer.last_ts, dtype=np.int64),
+                          np.array(still_open), np.full(len(still_open), EVENT_OFF, dtype=np.uint8))
+
+    last_date = max(day_date(int(importer.last_ts) // 86400), datetime.now().date())
+    imported_seconds = {}
+    for (_, name), seconds in store.usage_between(first_date, last_date).items():
+        imported_seconds[name] = imported_seconds.get(name, 0) + seconds
+    for (_, name), seconds in before.items():
+        imported_seconds[name] = imported_seconds.get(name, 0) - seconds
+
+    for name, seconds in imported_seconds.items():
+        if name not in existing:
+            if name not in importer.powers:
+                print(f"Skipping usage of '{name}': no power rating in the import.")
+                continue
+            meter.add_device(name, importer.powers[name])
+            existing.add(name)
+        device = meter.get(name)
+        device.saved_usage_units += (device.power * seconds) / (1000 * 3600)
+    meter.save()
+    return importer.rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import historical meter readings into WattWise")
+    parser.add_argument("username")
+    parser.add_argument("events", help="CSV or Parquet file with timestamp, device, state[, power] columns")
+    parser.add_argument("--devices", help="CSV or Parquet file with device, power columns")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    options = parser.parse_args()
+
+    if not os.path.exists(options.events):
+        raise SystemExit(f"No such file: {options.events}")
+    started = time.perf_counter()
+    try:
+        store = open_store(options.username)
+    except UserLockedError as e:
+        raise SystemExit(str(e))
+    try:
+        rows = import_history(options.username, options.events, options.devices, options.chunk_size, store)
+    except ValueError as e:
+        raise SystemExit(f"Import stopped: {e}")
+    finally:
+        store.close()
+    elapsed = time.perf_counter() - started
+    print(f"Imported {rows} events for {options.username} in {elapsed:.1f}s ({rows / max(elapsed, 1e-9) * 60:,.0f} rows/min).")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,417 @@
+import gzip
+import os
+import re
+import struct
+from datetime import datetime, timedelta
+
+# --- Event Types ---
+EVENT_ON = 1
+EVENT_OFF = 2
+EVENT_OFF_REMOVED = 3
+
+EVENT_LABELS = {EVENT_ON: "ON", EVENT_OFF: "OFF", EVENT_OFF_REMOVED: "OFF (Removed)"}
+
+# Timestamps are naive local wall-clock seconds since 1970-01-01, the same clock the
+# old text logs were written in, so a day boundary is always a multiple of 86400.
+_EPOCH = datetime(1970, 1, 1)
+SECONDS_PER_DAY = 86400
+
+MAGIC = b"WWJ1"
+HEADER = struct.Struct("<4s4xq")   # magic, logical index of the first record in the file
+RECORD = struct.Struct("<qIB3x")   # timestamp, device id, event type (16 bytes)
+
+# Compacted records live in '<prefix>.YYYY-MM.bin.gz': a HEADER followed by that month's records.
+_ARCHIVE_NAME = re.compile(r"\.(\d{4}-\d{2})\.bin\.gz$")
+
+
+def to_timestamp(dt):
+    """Converts a naive local datetime to journal seconds."""
+    return int((dt - _EPOCH).total_seconds())
+
+
+def from_timestamp(ts):
+    """Converts journal seconds back to a naive local datetime."""
+    return _EPOCH + timedelta(seconds=ts)
+
+
+def parse_log_line(line):
+    """Parses a legacy '[YYYY-mm-dd HH:MM:SS] Name turned ON/OFF' line. Returns None if malformed."""
+    stripped = line.strip()
+    try:
+        dt_obj = datetime.strptime(stripped[1:20], '%Y-%m-%d %H:%M:%S')
+        device_name, status_part = stripped[22:].split(' turned ', 1)
+    except ValueError:
+        return None
+    status = status_part.split(' ')[0].strip()
+    if status == "ON":
+        event = EVENT_ON
+    elif status == "OFF":
+        event = EVENT_OFF_REMOVED if "(Removed)" in status_part else EVENT_OFF
+    else:
+        return None
+    return dt_obj, device_name.strip(), event
+
+
+def format_log_line(ts, device_name, event):
+    """Renders a journal record in the legacy text log format."""
+    return f"[{from_timestamp(ts).strftime('%Y-%m-%d %H:%M:%S')}] {device_name} turned {EVENT_LABELS[event]}"
+
+
+def pair_sessions(records, start_ts, end_ts):
+    """Pairs time-ordered (ts, device, event) records starting at start_ts into (device, start, end) sessions."""
+    sessions, open_sessions, seen = [], {}, set()
+    for ts, device, event in records:
+        if ts > end_ts: break
+        if event == EVENT_ON:
+            open_sessions[device] = ts
+        elif device in open_sessions:
+            sessions.append((device, open_sessions.pop(device), ts))
+        elif device not in seen:
+            # The first event in the window is an OFF: the session began before it.
+            sessions.append((device, start_ts, ts))
+        seen.add(device)
+    sessions.extend((device, ts, end_ts) for device, ts in open_sessions.items())
+    return sessions
+
+
+def _month_starts(data):
+    """Returns [(YYYY-MM, first record position)] for time-ordered packed records.
+
+    Each month is one contiguous run, so its start is found by binary search instead of
+    formatting every record's timestamp.
+    """
+    count = len(data) // RECORD.size
+    starts, position = [], 0
+    while position < count:
+        month = from_timestamp(RECORD.unpack_from(data, position * RECORD.size)[0]).replace(day=1, hour=0, minute=0, second=0)
+        starts.append((month.strftime("%Y-%m"), position))
+        next_month = to_timestamp((month + timedelta(days=32)).replace(day=1))
+        low, high = position + 1, count
+        while low < high:
+            mid = (low + high) // 2
+            if RECORD.unpack_from(data, mid * RECORD.size)[0] < next_month:
+                low = mid + 1
+            else:
+                high = mid
+        position = low
+    return starts
+
+
+def _file_month_starts(path, count):
+    """Returns _month_starts for the first count records of a file, reading it in chunks."""
+    starts = []
+    with open(path, "rb") as f:
+        for offset in range(0, count, 1 << 16):
+            chunk = f.read(min(count - offset, 1 << 16) * RECORD.size)
+            for month, position in _month_starts(chunk):
+                if not starts or starts[-1][0] != month:
+                    starts.append((month, offset + position))
+    return starts
+
+
+class EventJournal:
+    """Append-only journal of fixed-width device ON/OFF records.
+
+    Records live in '<prefix>.bin'; device names are assigned ids in the order they are
+    first seen and kept one per line in '<prefix>.names'. Both files are only ever
+    appended to, so writing an event costs O(1) regardless of history length.
+
+    compact() moves old records into gzip'd monthly archive segments and restarts the
+    hot file at a higher base_index; records() still reads through the archives.
+    prepend() backfills older history as archive segments below the first index, which
+    may be negative.
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.path = prefix + ".bin"
+        self.names_path = prefix + ".names"
+        self.names = []
+        self.name_ids = {}
+        if os.path.exists(self.names_path):
+            with open(self.names_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    self._register_name(line.rstrip("\n"))
+        self.base_index = 0
+        self._open_records()
+
+    def _register_name(self, name):
+        self.name_ids[name] = len(self.names)
+        self.names.append(name)
+
+    def _open_records(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < HEADER.size:
+            with open(self.path, "wb") as f:
+                f.write(HEADER.pack(MAGIC, 0))
+        self._file = open(self.path, "r+b")
+        magic, self.base_index = HEADER.unpack(self._file.read(HEADER.size))
+        if magic != MAGIC:
+            self._file.close()
+            raise ValueError(f"{self.path} is not a WattWise event journal")
+        # Drop a partially written trailing record left behind by a crash.
+        size = os.path.getsize(self.path)
+        whole = HEADER.size + ((size - HEADER.size) // RECORD.size) * RECORD.size
+        if whole != size:
+            self._file.truncate(whole)
+        self._file.seek(0, os.SEEK_END)
+
+    @property
+    def end_index(self):
+        """Logical index one past the last record written."""
+        return self.base_index + (self._file.tell() - HEADER.size) // RECORD.size
+
+    @property
+    def first_index(self):
+        """Logical index of the oldest record, archived or not."""
+        segments = self._archive_segments()
+        if not segments: return self.base_index
+        with gzip.open(segments[0][1], "rb") as f:
+            return HEADER.unpack(f.read(HEADER.size))[1]
+
+    def record_offset(self, index):
+        """Byte offset of the record with the given logical index."""
+        return HEADER.size + (index - self.base_index) * RECORD.size
+
+    def device_id(self, name):
+        """Returns the id for a device name, assigning a new one if needed."""
+        device_id = self.name_ids.get(name)
+        if device_id is None:
+            with open(self.names_path, "a", encoding="utf-8") as f:
+                f.write(name + "\n")
+                f.flush()
+                os.fsync(f.fileno())  # Records refer to names by id, so a name must never be lost.
+            self._register_name(name)
+            device_id = self.name_ids[name]
+        return device_id
+
+    def name_of(self, device_id):
+        return self.names[device_id] if device_id < len(self.names) else None
+
+    def append(self, dt, device_name, event):
+        """Appends one event and returns its logical index."""
+        return self.append_many([(dt, device_name, event)])
+
+    def append_many(self, events, sync=False):
+        """Appends (datetime, device name, event) tuples in a single write and returns the first index.
+
+        With sync=True the records are fsync'd before returning, so a committed batch
+        survives a power loss; a torn trailing record is dropped on the next open.
+        """
+        return self.append_raw(b"".join(RECORD.pack(to_timestamp(dt), self.device_id(name), event) for dt, name, event in events), sync)
+
+    def append_raw(self, data, sync=False):
+        """Appends already packed RECORD bytes (e.g. from a numpy array) and returns the first index.
+
+        A write that fails is cut off again before the error is raised, so retrying the
+        same batch never leaves duplicate records behind.
+        """
+        index = self.end_index
+        size = self._file.tell()
+        try:
+            self._file.write(data)
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+        except OSError:
+            self._truncate_to(size)
+            raise
+        return index
+
+    def _truncate_to(self, size):
+        try:
+            self._file.close()  # Discards whatever is still buffered.
+        except OSError:
+            pass
+        with open(self.path, "r+b") as f:
+            f.truncate(size)
+        self._open_records()
+
+    def archive_path(self, month):
+        return f"{self.prefix}.{month}.bin.gz"
+
+    def _archive_segments(self):
+        """Returns [(month, path)] for every archive segment, oldest first."""
+        directory, base = os.path.split(self.prefix)
+        segments = []
+        for filename in os.listdir(directory or "."):
+            match = _ARCHIVE_NAME.search(filename)
+            if match and filename[:match.start()] == base:
+                segments.append((match.group(1), os.path.join(directory, filename)))
+        return sorted(segments)
+
+    @staticmethod
+    def _read_segment(path):
+        """Returns (base index, record bytes) of an archive segment."""
+        with gzip.open(path, "rb") as f:
+            data = f.read()
+        magic, base_index = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a WattWise journal archive")
+        data = data[HEADER.size:]
+        return base_index, data[:len(data) - len(data) % RECORD.size]
+
+    def read_archived(self, start_index=None):
+        """Returns the raw records from start_index (default: the oldest) up to base_index, read from the archive segments."""
+        segments = [self._read_segment(path) for _, path in self._archive_segments()]
+        chunks = []
+        for i, (segment_base, data) in enumerate(segments):
+            # An interrupted compaction can leave records in a segment that were also kept
+            # in the next segment or the hot file; those later copies win.
+            segment_end = segments[i + 1][0] if i + 1 < len(segments) else self.base_index
+            first = segment_base if start_index is None else max(start_index, segment_base)
+            last = min(segment_end, segment_base + len(data) // RECORD.size)
+            if first < last:
+                chunks.append(data[(first - segment_base) * RECORD.size:(last - segment_base) * RECORD.size])
+        return b"".join(chunks)
+
+    def records(self, start_index=None):
+        """Yields (index, timestamp, device_id, event) tuples from start_index (default: the oldest) onward."""
+        if start_index is None or start_index < self.base_index:
+            archived = self.read_archived(start_index)
+            index = self.base_index - len(archived) // RECORD.size
+            for ts, device_id, event in RECORD.iter_unpack(archived):
+                yield index, ts, device_id, event
+                index += 1
+        start_index = self.base_index if start_index is None else max(start_index, self.base_index)
+        index = start_index
+        with open(self.path, "rb") as f:
+            f.seek(self.record_offset(start_index))
+            while True:
+                chunk = f.read(RECORD.size * 4096)
+                usable = len(chunk) - len(chunk) % RECORD.size
+                if not usable: break
+                for ts, device_id, event in RECORD.iter_unpack(chunk[:usable]):
+                    yield index, ts, device_id, event
+                    index += 1
+
+    def first_timestamp(self):
+        """Returns the timestamp of the oldest record, or None if the journal is empty."""
+        for _, path in self._archive_segments():
+            _, data = self._read_segment(path)
+            if data:
+                return RECORD.unpack_from(data)[0]
+        if self.end_index > self.base_index:
+            with open(self.path, "rb") as f:
+                f.seek(self.record_offset(self.base_index))
+                return RECORD.unpack(f.read(RECORD.size))[0]
+        return None
+
+    def last_timestamp(self):
+        """Returns the timestamp of the newest record, or None if the journal is empty."""
+        if self.end_index > self.base_index:
+            with open(self.path, "rb") as f:
+                f.seek(self.record_offset(self.end_index - 1))
+                return RECORD.unpack(f.read(RECORD.size))[0]
+        segments = self._archive_segments()
+        if segments:
+            _, data = self._read_segment(segments[-1][1])
+            if data:
+                return RECORD.unpack_from(data, len(data) - RECORD.size)[0]
+        return None
+
+    def find_index(self, ts):
+        """Binary-searches for the first record at or after ts; records are appended in time order."""
+        low, high = self.base_index, self.end_index
+        with open(self.path, "rb") as f:
+            while low < high:
+                mid = (low + high) // 2
+                f.seek(self.record_offset(mid))
+                if RECORD.unpack(f.read(RECORD.size))[0] < ts:
+                    low = mid + 1
+                else:
+                    high = mid
+        return low
+
+    def sessions_between(self, start_ts, end_ts):
+        """Returns (device_id, start, end) ON sessions overlapping [start_ts, end_ts], clipped to it.
+
+        Sessions still running at end_ts are closed at end_ts.
+        """
+        start_index = self.find_index(start_ts)
+        if start_index == self.base_index and start_index > self.first_index:
+            start_index = None  # The window reaches back into the archives.
+        records = ((ts, device_id, event) for _, ts, device_id, event in self.records(start_index) if ts >= start_ts)
+        return pair_sessions(records, start_ts, end_ts)
+
+    def compact(self, before_ts, keep_from_index=None):
+        """Moves records older than before_ts (and below keep_from_index) into monthly archives.
+
+        Returns the number of records archived. Each affected segment is rewritten to a
+        temp file and renamed into place before the hot file is, so a crash at any point
+        leaves every record readable; see read_archived for how overlaps are resolved.
+        """
+        cut = self.find_index(before_ts)
+        if keep_from_index is not None:
+            cut = min(cut, keep_from_index)
+        if cut <= self.base_index: return 0
+        with open(self.path, "rb") as f:
+            f.seek(self.record_offset(self.base_index))
+            archived = f.read((cut - self.base_index) * RECORD.size)
+            kept = f.read()
+        kept = kept[:len(kept) - len(kept) % RECORD.size]
+
+        starts = _month_starts(archived)
+        for n, (month, first) in enumerate(starts):
+            last = starts[n + 1][1] if n + 1 < len(starts) else len(archived) // RECORD.size
+            first_index = self.base_index + first
+            segment_base, data = first_index, b""
+            path = self.archive_path(month)
+            if os.path.exists(path):
+                segment_base, data = self._read_segment(path)
+                if segment_base > first_index:
+                    segment_base, data = first_index, b""
+                data = data[:(first_index - segment_base) * RECORD.size]
+            new_records = archived[first * RECORD.size:last * RECORD.size]
+            self._replace_file(path, HEADER.pack(MAGIC, segment_base) + data + new_records, compress=True)
+
+        self._file.close()
+        self._replace_file(self.path, HEADER.pack(MAGIC, cut) + kept)
+        self._open_records()
+        return len(archived) // RECORD.size
+
+    def prepend(self, path):
+        """Inserts the time-ordered packed records of the file at path before the oldest record.
+
+        They are written as archive segments at indices below first_index; returns their
+        count. The month shared with the existing history is rewritten first and older
+        months follow newest first, so a crash part way leaves the newest part of the
+        backfill readable, with contiguous indices, and nothing else changed.
+        """
+        count = os.path.getsize(path) // RECORD.size
+        if not count: return 0
+        months = _file_month_starts(path, count)
+        segments = self._archive_segments()
+        end = self.first_index
+        with open(path, "rb") as f:
+            for n in range(len(months) - 1, -1, -1):
+                month, first = months[n]
+                last = months[n + 1][1] if n + 1 < len(months) else count
+                f.seek(first * RECORD.size)
+                data = f.read((last - first) * RECORD.size)
+                if segments and segments[0][0] == month:
+                    data += self._read_segment(segments[0][1])[1]
+                end -= last - first
+                self._replace_file(self.archive_path(month), HEADER.pack(MAGIC, end) + data, compress=True)
+        return count
+
+    @staticmethod
+    def _replace_file(path, data, compress=False):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as raw:
+            if compress:
+                # Level 6 compresses journal records nearly as well as 9 in a fraction of the time.
+                with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6) as f:
+                    f.write(data)
+            else:
+                raw.write(data)
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp_path, path)
+
+    def iter_log_lines(self, start_index=0):
+        """Yields the journal rendered in the legacy text log format."""
+        for _, ts, device_id, event in self.records(start_index):
+            yield format_log_line(ts, self.name_of(device_id), event)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
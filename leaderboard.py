@@ -0,0 +1,81 @@
+import json
+import os
+
+from datafile import read_data_file
+
+INDEX_FILE = "leaderboard_index.json"
+DATA_SUFFIX = "_data.txt"
+
+
+def read_saved_total(filename):
+    """Sums the saved usage of every device in a user's '## DEVICES ##' section."""
+    data = read_data_file(filename)
+    if data is None: raise FileNotFoundError(filename)
+    return data.saved_total
+
+
+class LeaderboardIndex:
+    """Cached per-user saved totals, validated against each data file's mtime and size.
+
+    Users update their own entry whenever they save, so rendering the leaderboard only
+    needs to stat the data files; a file is reparsed only when it changed behind the
+    index's back (an older app version, a copied-in file, ...).
+    """
+    def __init__(self, directory=".", path=INDEX_FILE):
+        self.directory = directory
+        self.path = os.path.join(directory, path)
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, entries):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _entry(stat, total):
+        return {"total": total, "mtime": stat.st_mtime_ns, "size": stat.st_size}
+
+    def signature(self):
+        """Cheap change marker: the index file and data directory modification times."""
+        try:
+            index_mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            index_mtime = None
+        return index_mtime, os.stat(self.directory).st_mtime_ns
+
+    def record(self, username, data_file, total):
+        """Stores a user's freshly saved total along with the data file's signature."""
+        entries = self._load()
+        entries[username] = self._entry(os.stat(data_file), total)
+        self._save(entries)
+
+    def totals(self):
+        """Returns {username: saved total} for every data file, reparsing only stale entries."""
+        entries = self._load()
+        totals, changed = {}, False
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(DATA_SUFFIX): continue
+            username = filename[:-len(DATA_SUFFIX)]
+            path = os.path.join(self.directory, filename)
+            try:
+                stat = os.stat(path)
+                entry = entries.get(username)
+                if not entry or entry["mtime"] != stat.st_mtime_ns or entry["size"] != stat.st_size:
+                    entry = entries[username] = self._entry(stat, read_saved_total(path))
+                    changed = True
+                totals[username] = entry["total"]
+            except OSError as e:
+                print(f"Could not read data from file {filename}: {e}")
+        for username in set(entries) - set(totals):
+            del entries[username]  # Data file was deleted.
+            changed = True
+        if changed:
+            self._save(entries)
+        return totals
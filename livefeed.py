@@ -0,0 +1,133 @@
+import threading
+from collections import deque
+
+# Seconds between usage ticks, matching the GUI's update_all_usages.
+TICK_INTERVAL = 1.0
+# Deltas a subscriber may have waiting before it is switched to a fresh snapshot instead.
+MAX_PENDING = 256
+# Usage is pushed when it changes at the precision the app displays (3 decimals).
+UNITS_PRECISION = 3
+
+
+class Subscription:
+    """One client's queue of pending deltas.
+
+    Pushing never blocks: when a slow client lets MAX_PENDING deltas pile up they are
+    dropped and the client is sent a full snapshot next, so it catches up without the
+    meter ever waiting on it.
+    """
+    def __init__(self, username, max_pending=MAX_PENDING):
+        self.username = username
+        self.max_pending = max_pending
+        self._pending = deque()
+        self._needs_snapshot = True  # Every client starts from a snapshot.
+        self._ready = threading.Condition()
+
+    def push(self, events):
+        with self._ready:
+            if self._needs_snapshot: return
+            if len(self._pending) + len(events) > self.max_pending:
+                self._pending.clear()
+                self._needs_snapshot = True
+            else:
+                self._pending.extend(events)
+            self._ready.notify()
+
+    def next(self, timeout):
+        """Waits for work. Returns "snapshot", a list of delta events, or None on timeout."""
+        with self._ready:
+            if not self._needs_snapshot and not self._pending:
+                self._ready.wait(timeout)
+            if self._needs_snapshot:
+                self._needs_snapshot = False
+                self._pending.clear()
+                return "snapshot"
+            if not self._pending:
+                return None
+            events = list(self._pending)
+            self._pending.clear()
+            return events
+
+
+class LiveFeed:
+    """Turns a MeterService's device state into per-user streams of deltas.
+
+    A tick thread samples every user that has subscribers once per TICK_INTERVAL and
+    pushes only what changed: devices added or removed, toggles, and totals crossing
+    the displayed precision. Mutating service calls trigger an immediate tick for that
+    user, so toggles show up without waiting for the next one.
+    """
+    def __init__(self, service, interval=TICK_INTERVAL):
+        self.service = service
+        self.interval = interval
+        self.subscribers = {}
+        self.last = {}
+        self.lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="live-feed", daemon=True)
+        service.listeners.append(self.tick_user)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self.tick_user in self.service.listeners:
+            self.service.listeners.remove(self.tick_user)
+
+    def subscribe(self, username):
+        subscription = Subscription(username)
+        with self.lock:
+            if username not in self.last:
+                # The first subscriber fixes the baseline, so a toggle before the next tick is still a delta.
+                self.last[username] = self._sample(username)
+            self.subscribers.setdefault(username, []).append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscribers.get(subscription.username, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+            if not subscriptions:
+                self.subscribers.pop(subscription.username, None)
+                self.last.pop(subscription.username, None)
+
+    def snapshot(self, username):
+        devices, _ = self.service.device_snapshot(username)
+        for device in devices:
+            device["total_units"] = round(device["total_units"], UNITS_PRECISION)
+        return {"type": "snapshot", "devices": devices}
+
+    def _sample(self, username):
+        devices, _ = self.service.device_snapshot(username)
+        return {d["name"]: (d["is_on"], round(d["total_units"], UNITS_PRECISION), d["power"]) for d in devices}
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            with self.lock:
+                usernames = list(self.subscribers)
+            for username in usernames:
+                self.tick_user(username)
+
+    def tick_user(self, username):
+        with self.lock:
+            subscriptions = list(self.subscribers.get(username, []))
+            if not subscriptions: return
+            current = self._sample(username)
+            previous = self.last.get(username, current)
+            self.last[username] = current
+
+        events = []
+        for name, (is_on, units, power) in current.items():
+            if name not in previous:
+                events.append({"type": "added", "name": name, "power": power, "is_on": is_on, "total_units": units})
+            elif is_on != previous[name][0]:
+                events.append({"type": "toggle", "name": name, "is_on": is_on, "total_units": units})
+            elif units != previous[name][1]:
+                events.append({"type": "usage", "name": name, "total_units": units})
+        events.extend({"type": "removed", "name": name} for name in previous if name not in current)
+        if events:
+            for subscription in subscriptions:
+                subscription.push(events)
@@ -0,0 +1,330 @@
+from datetime import datetime
+
+import numpy as np
+
+from journal import EVENT_ON, EVENT_OFF, EVENT_OFF_REMOVED, to_timestamp, from_timestamp
+from rollup import split_sessions_by_day, day_date, period_start, period_dates
+
+
+# Running sessions are stored as seconds since the journal epoch.
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _seconds(dt):
+    return (dt - _EPOCH).total_seconds()
+
+
+class Device:
+    """Represents a single electrical device with power rating and usage tracking.
+
+    A Device is a view onto one row of a DeviceRegistry, which holds the actual values;
+    one created on its own gets a registry of its own.
+    """
+    __slots__ = ("_registry", "_row")
+
+    def __init__(self, name, power, registry=None):
+        (registry if registry is not None else DeviceRegistry(1))._attach(self, name, power)
+
+    @property
+    def name(self):
+        return self._registry.names[self._row]
+
+    @property
+    def power(self):
+        return float(self._registry.power[self._row])
+
+    @power.setter
+    def power(self, value):
+        self._registry.power[self._row] = value
+
+    @property
+    def is_on(self):
+        return bool(self._registry.is_on[self._row])
+
+    @is_on.setter
+    def is_on(self, value):
+        self._registry.is_on[self._row] = value
+
+    @property
+    def session_usage_seconds(self):
+        return float(self._registry.session_seconds[self._row])
+
+    @session_usage_seconds.setter
+    def session_usage_seconds(self, value):
+        self._registry.session_seconds[self._row] = value
+
+    @property
+    def saved_usage_units(self):
+        return float(self._registry.saved_units[self._row])
+
+    @saved_usage_units.setter
+    def saved_usage_units(self, value):
+        self._registry.saved_units[self._row] = value
+
+    @property
+    def last_on_time(self):
+        seconds = self._registry.last_on[self._row]
+        return None if np.isnan(seconds) else from_timestamp(float(seconds))
+
+    @last_on_time.setter
+    def last_on_time(self, value):
+        self._registry.last_on[self._row] = np.nan if value is None else _seconds(value)
+
+    def toggle(self, now=None):
+        now = now or datetime.now()
+        if self.is_on:
+            self.is_on = False
+            if self.last_on_time:
+                self.session_usage_seconds += (now - self.last_on_time).total_seconds()
+                self.last_on_time = None
+        else:
+            self.is_on = True
+            self.last_on_time = now
+
+    def update_session_usage(self, now=None):
+        if self.is_on and self.last_on_time:
+            now = now or datetime.now()
+            self.session_usage_seconds += (now - self.last_on_time).total_seconds()
+            self.last_on_time = now
+
+    def get_session_units(self):
+        return (self.power * self.session_usage_seconds) / (1000 * 3600)
+
+    def get_total_units(self):
+        return self.saved_usage_units + self.get_session_units()
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "power": self.power,
+            "is_on": self.is_on,
+            "session_usage_seconds": self.session_usage_seconds,
+            "saved_usage_units": self.saved_usage_units,
+            "last_on_time": self.last_on_time.isoformat() if self.last_on_time else None,
+        }
+
+    def update_from_dict(self, state):
+        self.power = state["power"]
+        self.is_on = state["is_on"]
+        self.session_usage_seconds = state["session_usage_seconds"]
+        self.saved_usage_units = state["saved_usage_units"]
+        self.last_on_time = datetime.fromisoformat(state["last_on_time"]) if state["last_on_time"] else None
+
+
+class DeviceRegistry:
+    """A user's devices, stored column-wise with one NumPy array per field.
+
+    Devices are found through a name -> row dict, so lookups, adds and removes are O(1).
+    Rows stay in the order devices were added, which the Home list and the saved file
+    follow: a remove only blanks its row (zeroed, so the vector operations skip it), and
+    the blanks are compacted away in one pass by the next positional access, when the
+    arrays are full, or once they outnumber the live rows. Per-tick work
+    (advancing running sessions, summing totals) is one vectorized step over the arrays.
+    It iterates and indexes like the list of Device objects it replaces.
+    """
+    __slots__ = ("names", "index", "views", "removed", "power", "is_on", "session_seconds", "saved_units", "last_on")
+    _COLUMNS = ("power", "is_on", "session_seconds", "saved_units", "last_on")
+
+    def __init__(self, capacity=16):
+        self.names = []    # per row; None for a removed device
+        self.index = {}
+        self.views = []    # per row; None for a removed device
+        self.removed = 0   # blank rows not compacted yet
+        self.power = np.zeros(capacity)
+        self.is_on = np.zeros(capacity, dtype=bool)
+        self.session_seconds = np.zeros(capacity)
+        self.saved_units = np.zeros(capacity)
+        self.last_on = np.full(capacity, np.nan)
+
+    def _attach(self, device, name, power):
+        if name in self.index:
+            raise ValueError(f"A device named '{name}' already exists.")
+        if len(self.names) == len(self.power) and self.removed:
+            self._compact()
+        row = len(self.names)
+        if row == len(self.power):
+            # Doubling keeps appends amortized O(1).
+            for column in self._COLUMNS:
+                values = getattr(self, column)
+                grown = np.full(2 * len(values) or 1, np.nan if column == "last_on" else 0, dtype=values.dtype)
+                grown[:row] = values
+                setattr(self, column, grown)
+        self.power[row], self.is_on[row], self.session_seconds[row], self.saved_units[row], self.last_on[row] = power, False, 0, 0, np.nan
+        self.names.append(name)
+        self.views.append(device)
+        self.index[name] = row
+        device._registry, device._row = self, row
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        if self.removed:
+            return (view for view in self.views if view is not None)
+        return iter(self.views)
+
+    def __getitem__(self, position):
+        if self.removed:
+            self._compact()
+        return self.views[position]
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def get(self, name):
+        return self.views[self.index[name]]
+
+    def add(self, name, power):
+        return Device(name, power, self)
+
+    def remove(self, name):
+        """Removes a device; the returned Device keeps its last values in a registry of its own."""
+        row = self.index.pop(name)
+        device = self.views[row]
+        state = [getattr(self, column)[row] for column in self._COLUMNS]
+        self.power[row], self.is_on[row], self.session_seconds[row], self.saved_units[row], self.last_on[row] = 0, False, 0, 0, np.nan
+        self.names[row] = self.views[row] = None
+        self.removed += 1
+        if self.removed > len(self.index):
+            self._compact()  # Amortized O(1): at least as many removes happened since the last one.
+        DeviceRegistry(1)._attach(device, name, 0)
+        for column, value in zip(self._COLUMNS, state):
+            getattr(device._registry, column)[0] = value
+        return device
+
+    def _compact(self):
+        """Closes the gaps removes left, keeping the remaining devices in order."""
+        rows = [row for row, view in enumerate(self.views) if view is not None]
+        count, live = len(self.names), len(rows)
+        for column in self._COLUMNS:
+            values = getattr(self, column)
+            values[:live] = values[rows]
+            values[live:count] = np.nan if column == "last_on" else 0
+        self.names = [self.names[row] for row in rows]
+        self.views = [self.views[row] for row in rows]
+        for row, view in enumerate(self.views):
+            view._row = row
+            self.index[self.names[row]] = row
+        self.removed = 0
+
+    # --- Vectorized per-tick operations ---
+
+    def update_sessions(self, now=None):
+        """Advances every running device's session to now (Device.update_session_usage for all)."""
+        count = len(self.names)
+        running = self.is_on[:count] & ~np.isnan(self.last_on[:count])
+        if not running.any(): return
+        now = _seconds(now or datetime.now())
+        self.session_seconds[:count][running] += now - self.last_on[:count][running]
+        self.last_on[:count][running] = now
+
+    def total_units(self):
+        """Saved plus session units of all devices."""
+        count = len(self.names)
+        session_units = np.dot(self.power[:count], self.session_seconds[:count]) / (1000 * 3600)
+        return float(self.saved_units[:count].sum() + session_units)
+
+    def any_on(self):
+        return bool(self.is_on[:len(self.names)].any())
+
+    def consolidate(self, now=None):
+        """Folds every device's session usage into its saved total."""
+        count = len(self.names)
+        self.update_sessions(now)
+        self.saved_units[:count] += self.power[:count] * self.session_seconds[:count] / (1000 * 3600)
+        self.session_seconds[:count] = 0
+
+
+def daily_usage_seconds(store, devices, first_date, now):
+    """Returns {(date, device name): ON seconds} for the given devices from first_date through today."""
+    return usage_seconds(store, devices, first_date, now, "day")
+
+
+def usage_seconds(store, devices, first_date, now, period):
+    """Returns {(period start date, device name): ON seconds} per "day", "week" or "month".
+
+    The range runs from the period containing first_date through today.
+    """
+    device_names = [d.name for d in devices]
+    first_date = period_dates(first_date, now.date(), period)[0]
+    usage = {}
+
+    closed_usage = store.usage_by_period(first_date, now.date(), period)
+    open_sessions = store.open_sessions()
+    known = set(device_names)
+    for (date, device_name), seconds in closed_usage.items():
+        if device_name in known:
+            usage[(date, device_name)] = seconds
+
+    # Devices that are still running are split with the same batched routine.
+    live = [(open_sessions[d.name], i) for i, d in enumerate(devices) if d.is_on and d.name in open_sessions]
+    live_starts, live_indexes = [start for start, _ in live], [i for _, i in live]
+    live_usage = split_sessions_by_day(live_starts, [to_timestamp(now)] * len(live_starts), live_indexes)
+    for (day, i), seconds in live_usage.items():
+        key = (day_date(period_start(day, period)), device_names[i])
+        if day_date(day) >= first_date:
+            usage[key] = usage.get(key, 0) + seconds
+    return usage
+
+
+class Meter:
+    """Owns one user's devices and records their ON/OFF events in a UsageStore.
+
+    The GUI drives a Meter in-process by default; meterd runs one per user so metering
+    keeps going while no window is open.
+    """
+    def __init__(self, username, store):
+        self.username = username
+        self.store = store
+        self.devices = DeviceRegistry()
+
+    def get(self, name):
+        return self.devices.get(name)
+
+    def load(self):
+        """Loads the saved devices. Returns False if the user has no data yet."""
+        rows = self.store.load_devices()
+        for name, power, saved_usage in rows or []:
+            if name in self.devices:
+                print(f"Skipping duplicate device '{name}' in saved data.")
+                continue
+            self.devices.add(name, power).saved_usage_units = saved_usage
+        return rows is not None
+
+    def add_device(self, name, power):
+        return self.devices.add(name, power)
+
+    def remove_device(self, name):
+        device = self.get(name)
+        if device.is_on:
+            now = datetime.now()
+            device.toggle(now)
+            self.store.append_events([(now, device.name, EVENT_OFF_REMOVED)])
+        device.saved_usage_units += device.get_session_units()
+        device.session_usage_seconds = 0
+        self.devices.remove(name)
+        self.save()
+
+    def toggle(self, name, now=None, on=None):
+        """Flips a device, or with on=True/False switches it to that state (doing nothing if it is already there)."""
+        now = now or datetime.now()
+        device = self.get(name)
+        if on is not None and device.is_on == on:
+            return device
+        device.toggle(now)
+        self.store.append_events([(now, device.name, EVENT_ON if device.is_on else EVENT_OFF)])
+        return device
+
+    def consolidate(self, now=None):
+        """Folds every device's session usage into its saved total."""
+        self.devices.consolidate(now or datetime.now())
+
+    def save(self):
+        self.store.save_devices(self.devices)
+
+    def refresh(self):
+        """Returns whether devices changed behind the caller's back; never in-process, as this Meter owns the user."""
+        return False
+
+    def close(self):
+        self.store.close()
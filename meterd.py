@@ -0,0 +1,400 @@
+"""Headless metering daemon.
+
+Runs each user's Meter in one long-lived process so usage keeps being recorded while no
+window is open. GUIs attach with WATTWISE_DAEMON=host:port and talk to it over a
+localhost socket, one JSON object per line in each direction:
+
+    {"op": "toggle", "user": "alice", "args": {"name": "Heater", "on": true}}
+    {"ok": true, "result": [...]}
+
+Start it with `python meterd.py [--host 127.0.0.1] [--port 8765] [--http-port 8080]`; the
+optional HTTP port serves the JSON API in httpapi.py.
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import threading
+from datetime import date, datetime
+
+from meter import DeviceRegistry, Meter, daily_usage_seconds
+from storage import UsageStore, BufferedStore, open_store, open_leaderboard
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# Running sessions are folded into the saved totals this often, so a crash loses little.
+AUTOSAVE_INTERVAL = float(os.getenv("WATTWISE_AUTOSAVE_INTERVAL", "60"))
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(":")
+    return host or DEFAULT_HOST, int(port)
+
+
+class MeterError(RuntimeError):
+    """Raised on the client side when the daemon rejects a request."""
+
+
+# --- Server ---
+
+class MeterService:
+    """Holds one Meter per user and executes requests against them one at a time.
+
+    A user is only loaded when a client attaches to it, which makes the daemon that
+    user's owner (see storage.UserLock) until it exits. Other users are never loaded,
+    so autosave only writes data the daemon owns.
+    """
+    # Operations that change what a user's devices report; each bumps the user's version.
+    MUTATING_OPS = {"add_device", "remove_device", "toggle"}
+
+    def __init__(self):
+        self.meters = {}
+        self.found = {}
+        self.versions = {}
+        self.leaderboard = open_leaderboard()
+        self.listeners = []  # Called with a username after each mutating operation.
+        self.lock = threading.Lock()
+
+    def meter(self, username, attach=False):
+        meter = self.meters.get(username)
+        if meter is None:
+            if not attach:
+                raise KeyError(f"User '{username}' is not attached to this daemon")
+            # Raises UserLockedError while an in-process GUI or an import owns the user.
+            meter = Meter(username, BufferedStore(open_store(username)))
+            self.found[username] = meter.load()
+            self.meters[username] = meter
+        return meter
+
+    def handle(self, request):
+        handler = getattr(self, "op_" + request["op"], None)
+        if handler is None:
+            raise ValueError(f"Unknown operation '{request['op']}'")
+        with self.lock:
+            result = handler(self.meter(request["user"], attach=request["op"] == "attach"), **request.get("args", {}))
+            if request["op"] in self.MUTATING_OPS:
+                self.versions[request["user"]] = self.versions.get(request["user"], 0) + 1
+        if request["op"] in self.MUTATING_OPS:
+            for listener in self.listeners:
+                listener(request["user"])
+        return result
+
+    def version(self, username):
+        """Changes whenever the user's devices are added, removed or toggled."""
+        with self.lock:
+            return self.versions.get(username, 0)
+
+    def device_snapshot(self, username, now=None):
+        """Returns (device dicts with live total_units, any device running) read at one instant."""
+        now = now or datetime.now()
+        with self.lock:
+            meter = self.meter(username)
+            meter.devices.update_sessions(now)
+            devices = [{"name": device.name, "power": device.power, "is_on": device.is_on,
+                        "total_units": device.get_total_units()} for device in meter.devices]
+            return devices, meter.devices.any_on()
+
+    def daily_usage(self, username, first_date, now=None):
+        """Returns ({(date, device name): seconds}, {device name: power}) for the user's devices."""
+        now = now or datetime.now()
+        with self.lock:
+            meter = self.meter(username)
+            return (daily_usage_seconds(meter.store, meter.devices, first_date, now),
+                    {device.name: device.power for device in meter.devices})
+
+    def has_user(self, username):
+        """Whether a client has attached to username, so the daemon owns and meters it."""
+        with self.lock:
+            return username in self.meters
+
+    def leaderboard_totals(self, now=None):
+        """Saved totals for every user, with live totals for the users this daemon is metering."""
+        now = now or datetime.now()
+        with self.lock:
+            totals = self.leaderboard.totals()
+            for username, meter in self.meters.items():
+                meter.devices.update_sessions(now)
+                totals[username] = meter.devices.total_units()
+            return totals
+
+    def leaderboard_signature(self):
+        with self.lock:
+            return self.leaderboard.signature(), tuple(sorted(self.versions.items()))
+
+    @staticmethod
+    def _devices(meter):
+        return [device.to_dict() for device in meter.devices]
+
+    def op_attach(self, meter):
+        # A user created through an earlier attach has data now even though nothing was on disk.
+        return {"found": self.found[meter.username] or bool(meter.devices), "devices": self._devices(meter)}
+
+    def op_devices(self, meter):
+        return self._devices(meter)
+
+    def op_add_device(self, meter, name, power):
+        meter.add_device(name, power)
+        return self._devices(meter)
+
+    def op_remove_device(self, meter, name):
+        meter.remove_device(name)
+        return self._devices(meter)
+
+    def op_toggle(self, meter, name, on=None):
+        # Clients send the state they want, so a toggle based on a stale view cannot flip it back.
+        meter.toggle(name, on=on)
+        return self._devices(meter)
+
+    def op_consolidate(self, meter):
+        meter.consolidate()
+        return self._devices(meter)
+
+    def op_save(self, meter):
+        meter.save()
+        return self._devices(meter)
+
+    def op_usage_between(self, meter, first, last):
+        usage = meter.store.usage_between(date.fromisoformat(first), date.fromisoformat(last))
+        return [[day.isoformat(), name, seconds] for (day, name), seconds in usage.items()]
+
+    def op_usage_by_period(self, meter, first, last, period):
+        usage = meter.store.usage_by_period(date.fromisoformat(first), date.fromisoformat(last), period)
+        return [[start.isoformat(), name, seconds] for (start, name), seconds in usage.items()]
+
+    def op_open_sessions(self, meter):
+        return meter.store.open_sessions()
+
+    def op_sessions_between(self, meter, start, end):
+        return meter.store.sessions_between(start, end)
+
+    def op_iter_events(self, meter):
+        return [[dt.isoformat(), name, event] for dt, name, event in meter.store.iter_events()]
+
+    def op_leaderboard_totals(self, meter):
+        return meter.store.leaderboard_totals()
+
+    def op_signature(self, meter):
+        return meter.store.signature()
+
+    def autosave(self):
+        with self.lock:
+            for meter in self.meters.values():
+                try:
+                    meter.consolidate()
+                    meter.save()
+                except Exception as e:
+                    print(f"Autosave failed for {meter.username}: {e}")
+
+    def close(self):
+        with self.lock:
+            for meter in self.meters.values():
+                meter.consolidate()
+                meter.save()
+                meter.close()
+            self.meters.clear()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = {"ok": True, "result": self.server.service.handle(json.loads(line))}
+            except Exception as e:
+                response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+
+
+class MeterServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, service):
+        super().__init__(address, _RequestHandler)
+        self.service = service
+
+
+# --- Client ---
+
+class MeterClient:
+    """A connection to the daemon; calls are serialized so it can be shared between threads."""
+    def __init__(self, address, timeout=10):
+        self._sock = socket.create_connection(parse_address(address), timeout=timeout)
+        self._file = self._sock.makefile("rwb")
+        self._lock = threading.Lock()
+
+    def call(self, op, username, **args):
+        request = json.dumps({"op": op, "user": username, "args": args}) + "\n"
+        with self._lock:
+            self._file.write(request.encode("utf-8"))
+            self._file.flush()
+            line = self._file.readline()
+        if not line:
+            raise MeterError("The metering daemon closed the connection.")
+        response = json.loads(line)
+        if not response["ok"]:
+            raise MeterError(response["error"])
+        return response["result"]
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+
+class RemoteStore(UsageStore):
+    """Read side of a user's store, answered by the daemon that owns it."""
+    def __init__(self, username, client):
+        self.username = username
+        self.client = client
+
+    def _call(self, op, **args):
+        return self.client.call(op, self.username, **args)
+
+    def save_devices(self, devices):
+        self._call("save")
+
+    def iter_events(self):
+        for dt, name, event in self._call("iter_events"):
+            yield datetime.fromisoformat(dt), name, event
+
+    def usage_between(self, first_date, last_date):
+        rows = self._call("usage_between", first=first_date.isoformat(), last=last_date.isoformat())
+        return {(date.fromisoformat(day), name): seconds for day, name, seconds in rows}
+
+    def usage_by_period(self, first_date, last_date, period):
+        rows = self._call("usage_by_period", first=first_date.isoformat(), last=last_date.isoformat(), period=period)
+        return {(date.fromisoformat(start), name): seconds for start, name, seconds in rows}
+
+    def open_sessions(self):
+        return self._call("open_sessions")
+
+    def sessions_between(self, start_ts, end_ts):
+        return [tuple(session) for session in self._call("sessions_between", start=start_ts, end=end_ts)]
+
+    def leaderboard_totals(self):
+        return self._call("leaderboard_totals")
+
+    def signature(self):
+        return self._call("signature")
+
+
+class RemoteMeter:
+    """Meter-compatible client whose devices mirror the daemon's after every call."""
+    def __init__(self, username, client):
+        self.username = username
+        self.client = client
+        self.store = RemoteStore(username, client)
+        self.devices = DeviceRegistry()
+
+    def _call(self, op, **args):
+        return self.client.call(op, self.username, **args)
+
+    def _sync(self, states):
+        """Mirrors the daemon's devices; returns whether any was added, removed, toggled or re-rated."""
+        before = [(device.name, device.is_on, device.power) for device in self.devices]
+        # Device objects are reused so views bound to them stay valid.
+        names = {state["name"] for state in states}
+        for name in [device.name for device in self.devices if device.name not in names]:
+            self.devices.remove(name)
+        for state in states:
+            if state["name"] in self.devices:
+                device = self.devices.get(state["name"])
+            else:
+                device = self.devices.add(state["name"], state["power"])
+            device.update_from_dict(state)
+        return before != [(device.name, device.is_on, device.power) for device in self.devices]
+
+    def get(self, name):
+        return self.devices.get(name)
+
+    def load(self):
+        result = self._call("attach")
+        self._sync(result["devices"])
+        return result["found"]
+
+    def add_device(self, name, power):
+        self._sync(self._call("add_device", name=name, power=power))
+        return self.get(name)
+
+    def remove_device(self, name):
+        self._sync(self._call("remove_device", name=name))
+
+    def toggle(self, name, now=None, on=None):
+        # The daemon stamps the event with its own clock.
+        self._sync(self._call("toggle", name=name, on=on))
+        return self.get(name)
+
+    def consolidate(self, now=None):
+        self._sync(self._call("consolidate"))
+
+    def save(self):
+        self._sync(self._call("save"))
+
+    def refresh(self):
+        """Re-reads the daemon's devices, which the HTTP API or another window may have changed."""
+        return self._sync(self._call("devices"))
+
+    def close(self):
+        # Only the connection goes away; the daemon keeps metering.
+        self.client.close()
+
+
+def open_meter(username):
+    """Returns a RemoteMeter if WATTWISE_DAEMON names a reachable daemon, otherwise an in-process Meter."""
+    address = os.getenv("WATTWISE_DAEMON")
+    if address:
+        try:
+            return RemoteMeter(username, MeterClient(address))
+        except OSError as e:
+            print(f"Could not reach the metering daemon at {address} ({e}); metering in-process instead.")
+    return Meter(username, BufferedStore(open_store(username)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WattWise headless metering daemon")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--http-port", type=int, default=int(os.getenv("WATTWISE_HTTP_PORT", "0")),
+                        help="also serve the HTTP/JSON API on this port (0 disables it)")
+    options = parser.parse_args()
+
+    service = MeterService()
+    server = MeterServer((options.host, options.port), service)
+    api_server = None
+    if options.http_port:
+        from httpapi import ApiServer
+        api_server = ApiServer((options.host, options.http_port), service)
+        api_server.feed.start()
+        threading.Thread(target=api_server.serve_forever, name="http-api", daemon=True).start()
+        print(f"HTTP API listening on http://{options.host}:{options.http_port}/")
+    stopped = threading.Event()
+
+    def autosave_loop():
+        while not stopped.wait(AUTOSAVE_INTERVAL):
+            service.autosave()
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    threading.Thread(target=autosave_loop, name="autosave", daemon=True).start()
+    print(f"Metering daemon listening on {options.host}:{options.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stopped.set()
+        if api_server:
+            api_server.feed.stop()
+            api_server.shutdown()
+            api_server.server_close()
+        server.server_close()
+        service.close()
+        print("Metering daemon stopped; all users saved.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+
+from journal import from_timestamp
+
+# Seconds to wait for the model before giving up; override with WATTWISE_AI_TIMEOUT.
+DEFAULT_TIMEOUT = float(os.getenv("WATTWISE_AI_TIMEOUT", "30"))
+
+# Upper bound on the prompt size in characters (roughly 4 characters per token).
+PROMPT_CHAR_BUDGET = int(os.getenv("WATTWISE_AI_PROMPT_CHARS", "6000"))
+TOP_SESSIONS = 5
+PEAK_HOURS = 3
+
+# Cached answers are reused for identical usage summaries for this many seconds.
+CACHE_TTL = float(os.getenv("WATTWISE_AI_CACHE_TTL", str(6 * 3600)))
+CACHE_MAX_ENTRIES = 32
+
+# poll() outcomes
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+TIMED_OUT = "timed_out"
+CANCELLED = "cancelled"
+
+PROMPT_HEADER = (
+    "Analyze the following summary of device power usage and current device states.\n"
+    "Provide 3-5 concise, actionable, bulleted recommendations to save energy. "
+    "Use **bold**, *italics*, or __underline__ formatting to highlight key terms or actions.\n\n"
+)
+
+
+def _kwh(power, seconds):
+    return (power * seconds) / (1000 * 3600)
+
+
+def _hourly_seconds(start_ts, end_ts):
+    """Yields (hour of day, seconds) for each clock hour a session touches."""
+    while start_ts < end_ts:
+        hour_end = (start_ts // 3600 + 1) * 3600
+        yield (start_ts // 3600) % 24, min(end_ts, hour_end) - start_ts
+        start_ts = hour_end
+
+
+def build_prompt(devices, dates, daily_seconds, sessions, budget=PROMPT_CHAR_BUDGET):
+    """Builds a bounded-size prompt from aggregated usage instead of the raw event log.
+
+    dates are the days covered (oldest first), daily_seconds maps (date, device name) to
+    ON seconds, and sessions are (device name, start ts, end ts) tuples within those days.
+    Devices are listed heaviest first and whatever does not fit in the budget is dropped.
+    """
+    window_seconds = len(dates) * 86400
+    hourly = {}
+    for name, start_ts, end_ts in sessions:
+        device_hours = hourly.setdefault(name, [0] * 24)
+        for hour, seconds in _hourly_seconds(start_ts, end_ts):
+            device_hours[hour] += seconds
+
+    device_lines = []
+    for device in devices:
+        daily_kwh = [_kwh(device.power, daily_seconds.get((d, device.name), 0)) for d in dates]
+        on_seconds = sum(daily_seconds.get((d, device.name), 0) for d in dates)
+        device_hours = hourly.get(device.name, [0] * 24)
+        peaks = sorted((h for h in range(24) if device_hours[h] > 0), key=lambda h: -device_hours[h])[:PEAK_HOURS]
+        line = (f"- {device.name} ({device.power}W, {'ON' if device.is_on else 'OFF'}): "
+                f"{sum(daily_kwh):.3f} kWh in {len(dates)} days, duty cycle {100 * on_seconds / window_seconds:.1f}%, "
+                f"daily kWh [{', '.join(f'{kwh:.2f}' for kwh in daily_kwh)}], "
+                f"peak hours {', '.join(f'{h:02d}:00' for h in peaks) or 'none'}, "
+                f"lifetime {device.get_total_units():.3f} units")
+        device_lines.append((sum(daily_kwh), line))
+    device_lines.sort(key=lambda item: -item[0])
+
+    power_map = {d.name: d.power for d in devices}
+    longest = sorted((s for s in sessions if s[0] in power_map), key=lambda s: -(s[2] - s[1]))[:TOP_SESSIONS]
+    session_lines = [
+        f"- {name}: {from_timestamp(start_ts).strftime('%a %b %d %H:%M')} for {(end_ts - start_ts) / 3600:.1f} h "
+        f"({_kwh(power_map[name], end_ts - start_ts):.3f} kWh)"
+        for name, start_ts, end_ts in longest
+    ]
+
+    prompt = PROMPT_HEADER + f"Devices over the last {len(dates)} days (ordered by energy used):\n"
+    for shown, (_, line) in enumerate(device_lines):
+        if len(prompt) + len(line) + 1 > budget:
+            prompt += f"- ({len(device_lines) - shown} smaller devices omitted)\n"
+            break
+        prompt += line + "\n"
+    if session_lines:
+        prompt += "\nLongest Sessions:\n"
+        for line in session_lines:
+            if len(prompt) + len(line) + 1 > budget: break
+            prompt += line + "\n"
+    return prompt[:budget]
+
+
+def fingerprint(prompt):
+    """Hashes a usage summary into a cache key."""
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+class RecommendationCache:
+    """On-disk cache of model answers keyed by usage fingerprint, with TTL and LRU eviction."""
+    def __init__(self, path, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        try:
+            with open(path, "r") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Could not save recommendation cache: {e}")
+
+    def get(self, key):
+        """Returns the cached text for key, or None if missing or expired."""
+        entry = self.entries.get(key)
+        if entry is None: return None
+        now = time.time()
+        if now - entry["created"] > self.ttl:
+            del self.entries[key]
+            self._save()
+            return None
+        entry["used"] = now
+        self._save()
+        return entry["text"]
+
+    def put(self, key, text):
+        now = time.time()
+        self.entries[key] = {"text": text, "created": now, "used": now}
+        # Drop expired entries first, then the least recently used ones.
+        for stale_key in [k for k, e in self.entries.items() if now - e["created"] > self.ttl]:
+            del self.entries[stale_key]
+        while len(self.entries) > self.max_entries:
+            del self.entries[min(self.entries, key=lambda k: self.entries[k]["used"])]
+        self._save()
+
+
+class RecommendationJob:
+    """Runs one blocking model call on a worker thread.
+
+    Tk widgets may only be touched from the main thread, so the worker never calls back
+    into the UI; it drops its result into a queue that the app polls with `after`.
+    """
+    def __init__(self, fetch, timeout=DEFAULT_TIMEOUT, key=None):
+        self._fetch = fetch
+        self.key = key
+        self._results = queue.Queue(maxsize=1)
+        self._cancelled = threading.Event()
+        self.deadline = time.monotonic() + timeout
+        self._thread = threading.Thread(target=self._run, name="ai-recommendations", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            self._results.put((DONE, self._fetch()))
+        except Exception as e:
+            self._results.put((FAILED, e))
+
+    def cancel(self):
+        """Abandons the job. The network call cannot be interrupted, but its result is discarded."""
+        self._cancelled.set()
+
+    def poll(self):
+        """Returns (status, payload) without blocking; payload is the text or the exception."""
+        if self._cancelled.is_set():
+            return CANCELLED, None
+        try:
+            return self._results.get_nowait()
+        except queue.Empty:
+            if time.monotonic() >= self.deadline:
+                self.cancel()
+                return TIMED_OUT, None
+            return PENDING, None
@@ -0,0 +1,236 @@
+import json
+import os
+from datetime import date, timedelta
+
+import numpy as np
+
+from datafile import atomic_write
+from journal import EVENT_ON, SECONDS_PER_DAY
+
+_DAY_ZERO = date(1970, 1, 1)
+
+# The rollup file is rewritten in full only once the deltas appended since the last full
+# write outgrow it (and this many bytes), keeping saves O(changed days) and loads bounded.
+REWRITE_MIN_BYTES = 64 * 1024
+
+# Mirrors journal.RECORD so whole journal segments can be loaded with one read.
+RECORD_DTYPE = np.dtype([("ts", "<i8"), ("device", "<u4"), ("event", "u1"), ("pad", "V3")])
+
+
+def day_number(d):
+    """Converts a date to the journal's day number (days since 1970-01-01)."""
+    return (d - _DAY_ZERO).days
+
+
+def day_date(day):
+    return _DAY_ZERO + timedelta(days=day)
+
+
+def period_start(day, period):
+    """Returns the day number starting the "day", "week" (Monday) or "month" that contains day."""
+    if period == "week":
+        return day - (day + 3) % 7  # 1970-01-01 was a Thursday.
+    if period == "month":
+        return day - day_date(day).day + 1
+    return day
+
+
+def period_dates(first_date, last_date, period):
+    """Returns the start dates of the periods covering first_date through last_date."""
+    day, last_day = period_start(day_number(first_date), period), day_number(last_date)
+    starts = []
+    while day <= last_day:
+        starts.append(day_date(day))
+        day = period_start(day + 31, period) if period == "month" else day + (7 if period == "week" else 1)
+    return starts
+
+
+def split_sessions_by_day(starts, ends, device_ids):
+    """Splits sessions at midnight and totals the ON seconds per (day, device) in one pass.
+
+    Takes parallel sequences of start/end journal timestamps and device ids and returns
+    {(day number, device_id): seconds}.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    device_ids = np.asarray(device_ids, dtype=np.int64)
+    valid = ends > starts
+    starts, ends, device_ids = starts[valid], ends[valid], device_ids[valid]
+    if not len(starts): return {}
+
+    # One row per (session, day touched): repeat each session once per day it spans.
+    first_days = starts // SECONDS_PER_DAY
+    day_counts = (ends - 1) // SECONDS_PER_DAY - first_days + 1
+    session_rows = np.repeat(np.arange(len(starts)), day_counts)
+    day_offsets = np.arange(len(session_rows)) - np.repeat(np.cumsum(day_counts) - day_counts, day_counts)
+    days = first_days[session_rows] + day_offsets
+
+    seg_starts = np.maximum(starts[session_rows], days * SECONDS_PER_DAY)
+    seg_ends = np.minimum(ends[session_rows], (days + 1) * SECONDS_PER_DAY)
+    keys, inverse = np.unique(days * (1 << 32) + device_ids[session_rows], return_inverse=True)
+    totals = np.bincount(inverse, weights=seg_ends - seg_starts)
+    return {(int(key >> 32), int(key & 0xFFFFFFFF)): float(total) for key, total in zip(keys, totals)}
+
+
+class DailyRollup:
+    """Per-(day, device) ON seconds, folded in incrementally from the event journal.
+
+    The rollup remembers the journal index it has processed up to, so reopening it only
+    replays events written since the last checkpoint instead of the whole history.
+    Weekly and monthly totals are kept alongside the daily ones (and rebuilt from them
+    on load), so a year of usage is read from a dozen entries rather than 365.
+
+    The file holds one JSON record per line: a full snapshot, then one record per save
+    with the checkpoint, the open sessions and only the seconds added since the previous
+    save. A record torn by a crash is skipped; its events are replayed from the journal.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.reset()
+        self._snapshot_bytes = 0  # size of the full snapshot the file starts with
+        self._appended_bytes = 0  # size of the delta records after it
+        if os.path.exists(path):
+            self._load()
+        for day, usage in self.days.items():
+            self._add_to_tiers(day, usage)
+
+    def reset(self):
+        """Forgets all usage, so the next catch_up replays the journal from its oldest record."""
+        self.checkpoint = None    # journal index of the next unprocessed record; None before the oldest
+        self.open_sessions = {}   # device_id -> ON timestamp
+        self.days = {}            # day number -> {device_id: seconds}
+        self.tiers = {"week": {}, "month": {}}  # period start day -> {device_id: seconds}
+        self._changed = {}        # day number -> {device_id: seconds added since the last save}
+        self._rewrite = True      # the next save writes a full snapshot
+
+    def _load(self):
+        with open(self.path, "r") as f:
+            records = f.read().split("\n")
+        for n, record in enumerate(records):
+            if not record: continue
+            try:
+                state = json.loads(record)
+                checkpoint = state["checkpoint"]
+                open_sessions = {int(k): v for k, v in state["open_sessions"].items()}
+                days = {int(day): {int(k): v for k, v in usage.items()} for day, usage in state["days"].items()}
+            except (ValueError, KeyError, AttributeError) as e:
+                if n == 0:
+                    print(f"Discarding unreadable rollup {self.path}: {e}")
+                    return
+                print(f"Skipping a torn record in {self.path}: {e}")
+                continue
+            self.checkpoint, self.open_sessions = checkpoint, open_sessions
+            for day, usage in days.items():
+                totals = self.days.setdefault(day, {})
+                for device_id, seconds in usage.items():
+                    totals[device_id] = totals.get(device_id, 0) + seconds
+        self._snapshot_bytes = len(records[0])
+        self._appended_bytes = sum(len(record) + 1 for record in records[1:])
+        self._rewrite = False
+
+    def _add_to_tiers(self, day, usage):
+        for period, tier in self.tiers.items():
+            totals = tier.setdefault(period_start(day, period), {})
+            for device_id, seconds in usage.items():
+                totals[device_id] = totals.get(device_id, 0) + seconds
+
+    def _add_sessions(self, starts, ends, device_ids):
+        for (day, device_id), seconds in split_sessions_by_day(starts, ends, device_ids).items():
+            usage = self.days.setdefault(day, {})
+            usage[device_id] = usage.get(device_id, 0) + seconds
+            changed = self._changed.setdefault(day, {})
+            changed[device_id] = changed.get(device_id, 0) + seconds
+            self._add_to_tiers(day, {device_id: seconds})
+
+    def apply(self, index, ts, device_id, event):
+        """Folds one journal record into the rollup. Records before the checkpoint are ignored."""
+        if index < self.checkpoint: return
+        if event == EVENT_ON:
+            self.open_sessions[device_id] = ts
+        elif device_id in self.open_sessions:
+            self._add_sessions([self.open_sessions.pop(device_id)], [ts], [device_id])
+        self.checkpoint = index + 1
+
+    def catch_up(self, journal):
+        """Applies all journal records written since the last checkpoint in one vectorized batch."""
+        if self.checkpoint is None:
+            self.checkpoint = journal.first_index
+        start_index, end_index = self.checkpoint, journal.end_index
+        if end_index <= start_index: return
+        hot_start = max(start_index, journal.base_index)
+        records = np.fromfile(journal.path, dtype=RECORD_DTYPE, count=end_index - hot_start,
+                              offset=journal.record_offset(hot_start))
+        if start_index < journal.base_index:
+            # The rollup is older than the last compaction (or was deleted): replay the archives too.
+            archived = np.frombuffer(journal.read_archived(start_index), dtype=RECORD_DTYPE)
+            records = np.concatenate([archived, records])
+
+        # Sessions still open at the checkpoint act as ON records preceding the batch.
+        carried = np.array(list(self.open_sessions.items()), dtype=np.int64).reshape(-1, 2)
+        ts = np.concatenate([carried[:, 1], records["ts"]])
+        devices = np.concatenate([carried[:, 0], records["device"].astype(np.int64)])
+        events = np.concatenate([np.full(len(carried), EVENT_ON, dtype=np.uint8), records["event"]])
+
+        # Group each device's events in journal order. An OFF closes a session exactly when the
+        # device's previous event was an ON; a later ON simply replaces an earlier one.
+        order = np.lexsort((np.arange(len(ts)), devices))
+        ts, devices, events = ts[order], devices[order], events[order]
+        same_device = devices[1:] == devices[:-1]
+        closes = same_device & (events[:-1] == EVENT_ON) & (events[1:] != EVENT_ON)
+        self._add_sessions(ts[:-1][closes], ts[1:][closes], devices[1:][closes])
+
+        last_of_device = np.append(~same_device, True)
+        still_open = last_of_device & (events == EVENT_ON)
+        self.open_sessions = {int(d): int(t) for d, t in zip(devices[still_open], ts[still_open])}
+        self.checkpoint = end_index
+
+    def usage_between(self, first_day, last_day):
+        """Returns {(date, device_id): seconds} for closed sessions in the inclusive date range."""
+        result = {}
+        for day in range(day_number(first_day), day_number(last_day) + 1):
+            for device_id, seconds in self.days.get(day, {}).items():
+                result[(day_date(day), device_id)] = seconds
+        return result
+
+    def usage_by_period(self, first_day, last_day, period):
+        """Returns {(period start date, device_id): seconds} from the coarsest tier matching period.
+
+        The range is widened to start on a period boundary, so each whole period is a
+        single lookup. The last period may run past last_day and is summed from the days.
+        """
+        if period == "day":
+            return self.usage_between(first_day, last_day)
+        tier = self.tiers[period]
+        starts = period_dates(first_day, last_day, period)
+        result = {}
+        for start in starts[:-1]:
+            for device_id, seconds in tier.get(day_number(start), {}).items():
+                result[(start, device_id)] = seconds
+        for (_, device_id), seconds in self.usage_between(starts[-1], last_day).items():
+            key = (starts[-1], device_id)
+            result[key] = result.get(key, 0) + seconds
+        return result
+
+    def save(self):
+        """Appends the days changed since the last save, so a save costs O(changed days).
+
+        Once the appended records outgrow the snapshot they follow, the file is rewritten
+        as a single new snapshot instead, which keeps the file and load time bounded.
+        """
+        if self._rewrite or self._appended_bytes > max(self._snapshot_bytes, REWRITE_MIN_BYTES):
+            snapshot = json.dumps({"checkpoint": self.checkpoint, "open_sessions": self.open_sessions, "days": self.days})
+            atomic_write(self.path, lambda f: f.write(snapshot))
+            self._snapshot_bytes, self._appended_bytes, self._rewrite = len(snapshot), 0, False
+        else:
+            record = "\n" + json.dumps({"checkpoint": self.checkpoint, "open_sessions": self.open_sessions, "days": self._changed})
+            try:
+                with open(self.path, "a") as f:
+                    f.write(record)
+                    f.flush()
+                    os.fsync(f.fileno())
+            except OSError:
+                # The record may have landed anyway; a full snapshot can't count it twice.
+                self._rewrite = True
+                raise
+            self._appended_bytes += len(record)
+        self._changed = {}
@@ -0,0 +1,301 @@
+import sqlite3
+import threading
+
+from journal import EVENT_ON, SECONDS_PER_DAY, to_timestamp, from_timestamp, pair_sessions
+from rollup import split_sessions_by_day, day_number, day_date, period_start, period_dates
+from storage import UsageStore, device_rows
+
+DEFAULT_DB_FILE = "wattwise.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    user TEXT NOT NULL,
+    name TEXT NOT NULL,
+    power REAL NOT NULL,
+    saved_units REAL NOT NULL DEFAULT 0,
+    position INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user, name)
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    user TEXT NOT NULL,
+    device TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    event INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_user_device_ts ON events (user, device, ts);
+CREATE INDEX IF NOT EXISTS events_user_ts ON events (user, ts);
+CREATE TABLE IF NOT EXISTS daily_rollup (
+    user TEXT NOT NULL,
+    day INTEGER NOT NULL,
+    device TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    PRIMARY KEY (user, day, device)
+);
+CREATE TABLE IF NOT EXISTS weekly_rollup (
+    user TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    device TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    PRIMARY KEY (user, start, device)
+);
+CREATE TABLE IF NOT EXISTS monthly_rollup (
+    user TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    device TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    PRIMARY KEY (user, start, device)
+);
+"""
+
+# Coarser rollups, keyed by the day number a week (Monday) or month starts on, so a long
+# Stats window reads one row per period and device instead of one per day.
+TIER_TABLES = {"week": "weekly_rollup", "month": "monthly_rollup"}
+
+# Each period's start day as an expression over daily_rollup.day.
+_PERIOD_STARTS = {
+    "day": "day",
+    "week": "day - (day + 3) % 7",
+    "month": "day - CAST(strftime('%d', day * 86400, 'unixepoch') AS INTEGER) + 1",
+}
+
+
+def _leaderboard_totals(conn):
+    return dict(conn.execute("SELECT user, SUM(saved_units) FROM devices GROUP BY user"))
+
+
+class SQLiteLeaderboard:
+    """Saved totals of every user in the database, for readers that are not tied to one user."""
+    def __init__(self, path=DEFAULT_DB_FILE):
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def totals(self):
+        with self.lock:
+            return _leaderboard_totals(self.conn)
+
+    def signature(self):
+        with self.lock:
+            return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+
+class SQLiteStore(UsageStore):
+    """Stores one user's devices, events and daily rollup in a shared SQLite database.
+
+    The database runs in WAL mode so several app instances can read while one writes,
+    and every batch of events is written in a single transaction together with the
+    rollup rows it affects.
+    """
+    def __init__(self, username, path=DEFAULT_DB_FILE):
+        self.username = username
+        self.path = path
+        # Writes may come from storage.BufferedStore's writer thread; it serializes all access.
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # Events arrive in group commits, so every transaction can afford a full sync.
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.executescript(SCHEMA)
+        if self.conn.execute("SELECT NOT EXISTS (SELECT 1 FROM monthly_rollup WHERE user = ?) "
+                             "AND EXISTS (SELECT 1 FROM daily_rollup WHERE user = ?)", (username, username)).fetchone()[0]:
+            # A database from before the tiers existed.
+            with self.conn:
+                self._rebuild_tiers(None, 0)
+        self._open_sessions = self._load_open_sessions()
+        self._inserted_from = None  # oldest event insert_bulk added since the last finish_inserts()
+        self._inserted_devices = set()
+
+    def _load_open_sessions(self):
+        # A device has an open session when its latest event is an ON. Backfilled events
+        # get higher ids than newer ones, so "latest" is by time, with the id breaking ties.
+        return dict(self.conn.execute(
+            "SELECT device, ts FROM events e WHERE user = ? AND event = ? AND NOT EXISTS "
+            "(SELECT 1 FROM events l WHERE l.user = e.user AND l.device = e.device "
+            "AND (l.ts > e.ts OR (l.ts = e.ts AND l.id > e.id)))",
+            (self.username, EVENT_ON)))
+
+    def is_empty(self):
+        return self.conn.execute(
+            "SELECT NOT EXISTS (SELECT 1 FROM devices WHERE user = ?) AND NOT EXISTS (SELECT 1 FROM events WHERE user = ?)",
+            (self.username, self.username)).fetchone()[0]
+
+    def load_devices(self):
+        """Returns the saved (name, power, saved units) rows in display order."""
+        if self.is_empty(): return None
+        return self.conn.execute(
+            "SELECT name, power, saved_units FROM devices WHERE user = ? ORDER BY position",
+            (self.username,)).fetchall()
+
+    def save_devices(self, devices):
+        self._save_rows(device_rows(devices))
+
+    def _save_rows(self, rows):
+        with self.conn:
+            self.conn.execute("DELETE FROM devices WHERE user = ?", (self.username,))
+            self.conn.executemany(
+                "INSERT INTO devices (user, name, power, saved_units, position) VALUES (?, ?, ?, ?, ?)",
+                [(self.username, name, power, saved, i) for i, (name, power, saved) in enumerate(rows)])
+
+    def import_from(self, store):
+        """Copies the devices and full event history of another UsageStore into this database."""
+        rows = store.load_devices() or []
+        events = list(store.iter_events())
+        self.append_events(events)
+        self._save_rows(rows)
+        print(f"Imported {len(rows)} devices and {len(events)} events for {self.username} into {self.path}.")
+
+    def append_events(self, events):
+        """Writes (datetime, device name, event) tuples and their rollup updates in one transaction."""
+        self._append_timestamped((to_timestamp(dt), device_name, event) for dt, device_name, event in events)
+
+    def append_bulk(self, timestamps, device_names, events):
+        self._append_timestamped(zip(timestamps.tolist(), device_names.tolist(), events.tolist()))
+
+    def _append_timestamped(self, events):
+        # Sessions are paired on a copy that replaces the real state only once the
+        # transaction commits, so a batch that fails can be retried as is.
+        open_sessions = dict(self._open_sessions)
+        rows, closed = [], []
+        for ts, device_name, event in events:
+            rows.append((self.username, device_name, ts, event))
+            if event == EVENT_ON:
+                open_sessions[device_name] = ts
+            elif device_name in open_sessions:
+                closed.append((open_sessions.pop(device_name), ts, device_name))
+
+        rollup_rows, tier_rows = [], {period: {} for period in TIER_TABLES}
+        if closed:
+            names = sorted({name for _, _, name in closed})
+            name_ids = {name: i for i, name in enumerate(names)}
+            starts, ends, device_names = zip(*closed)
+            usage = split_sessions_by_day(starts, ends, [name_ids[name] for name in device_names])
+            rollup_rows = [(self.username, day, names[i], seconds) for (day, i), seconds in usage.items()]
+            for (day, i), seconds in usage.items():
+                for period, totals in tier_rows.items():
+                    key = (period_start(day, period), names[i])
+                    totals[key] = totals.get(key, 0) + seconds
+        with self.conn:
+            self.conn.executemany("INSERT INTO events (user, device, ts, event) VALUES (?, ?, ?, ?)", rows)
+            self.conn.executemany(
+                "INSERT INTO daily_rollup (user, day, device, seconds) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (user, day, device) DO UPDATE SET seconds = seconds + excluded.seconds",
+                rollup_rows)
+            for period, table in TIER_TABLES.items():
+                self.conn.executemany(
+                    f"INSERT INTO {table} (user, start, device, seconds) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (user, start, device) DO UPDATE SET seconds = seconds + excluded.seconds",
+                    [(self.username, start, name, seconds) for (start, name), seconds in tier_rows[period].items()])
+        self._open_sessions = open_sessions
+
+    def insert_bulk(self, timestamps, device_names, events):
+        # Rows join the transaction finish_inserts() commits, so a failed import adds nothing.
+        self.conn.executemany("INSERT INTO events (user, device, ts, event) VALUES (?, ?, ?, ?)",
+                              [(self.username, name, ts, event) for ts, name, event
+                               in zip(timestamps.tolist(), device_names.tolist(), events.tolist())])
+        if len(timestamps):
+            first = int(timestamps[0])
+            self._inserted_from = first if self._inserted_from is None else min(self._inserted_from, first)
+            self._inserted_devices.update(device_names.tolist())
+
+    def finish_inserts(self):
+        """Recomputes the rollup of the devices insert_bulk touched, from the first day it touched.
+
+        A session spanning that day keeps its earlier part: events inserted on or after the
+        day can only move where it ends.
+        """
+        if self._inserted_from is None: return
+        first_day = self._inserted_from // SECONDS_PER_DAY
+        names = sorted(self._inserted_devices)
+        closed = []
+        for i, name in enumerate(names):
+            rows = self.conn.execute(
+                "SELECT ts, event FROM events WHERE user = ? AND device = ? AND ts >= COALESCE("
+                "(SELECT MAX(ts) FROM events WHERE user = ? AND device = ? AND ts < ?), ?) ORDER BY ts, id",
+                (self.username, name, self.username, name, first_day * SECONDS_PER_DAY, first_day * SECONDS_PER_DAY))
+            on_ts = None
+            for ts, event in rows:
+                if event == EVENT_ON:
+                    on_ts = ts
+                elif on_ts is not None:
+                    closed.append((on_ts, ts, i))
+                    on_ts = None
+        usage = split_sessions_by_day([c[0] for c in closed], [c[1] for c in closed], [c[2] for c in closed])
+        with self.conn:
+            self.conn.executemany("DELETE FROM daily_rollup WHERE user = ? AND device = ? AND day >= ?",
+                                  [(self.username, name, first_day) for name in names])
+            self.conn.executemany("INSERT INTO daily_rollup (user, day, device, seconds) VALUES (?, ?, ?, ?)",
+                                  [(self.username, day, names[i], seconds) for (day, i), seconds in usage.items()
+                                   if day >= first_day])
+            self._rebuild_tiers(names, first_day)
+        self._inserted_from, self._inserted_devices = None, set()
+        self._open_sessions = self._load_open_sessions()
+
+    def _rebuild_tiers(self, names, first_day):
+        """Re-sums the weekly and monthly rows of the named devices (None: all) from daily_rollup,
+        for the periods from the one containing first_day onward. Runs inside the caller's transaction."""
+        device_filter = "" if names is None else f" AND device IN ({', '.join('?' * len(names))})"
+        for period, table in TIER_TABLES.items():
+            start = period_start(first_day, period)
+            args = (self.username, start, *(names or ()))
+            self.conn.execute(f"DELETE FROM {table} WHERE user = ? AND start >= ?{device_filter}", args)
+            self.conn.execute(
+                f"INSERT INTO {table} (user, start, device, seconds) "
+                f"SELECT user, {_PERIOD_STARTS[period]}, device, SUM(seconds) FROM daily_rollup "
+                f"WHERE user = ? AND day >= ?{device_filter} GROUP BY 2, device", args)
+
+    def iter_events(self):
+        rows = self.conn.execute("SELECT ts, device, event FROM events WHERE user = ? ORDER BY ts, id", (self.username,))
+        for ts, device_name, event in rows:
+            yield from_timestamp(ts), device_name, event
+
+    def last_timestamp(self):
+        return self.conn.execute("SELECT MAX(ts) FROM events WHERE user = ?", (self.username,)).fetchone()[0]
+
+    def open_sessions(self):
+        return dict(self._open_sessions)
+
+    def usage_between(self, first_date, last_date):
+        """Returns {(date, device name): seconds} for closed sessions in the inclusive date range."""
+        rows = self.conn.execute(
+            "SELECT day, device, SUM(seconds) FROM daily_rollup "
+            "WHERE user = ? AND day BETWEEN ? AND ? GROUP BY day, device",
+            (self.username, day_number(first_date), day_number(last_date)))
+        return {(day_date(day), device): seconds for day, device, seconds in rows}
+
+    def usage_by_period(self, first_date, last_date, period):
+        """Returns {(period start date, device name): seconds} from the weekly or monthly table.
+
+        Whole periods are one row per device; the last one may run past last_date, so it
+        is summed from daily_rollup, as rollup.DailyRollup.usage_by_period does.
+        """
+        if period == "day":
+            return self.usage_between(first_date, last_date)
+        starts = period_dates(first_date, last_date, period)
+        rows = self.conn.execute(
+            f"SELECT start, device, seconds FROM {TIER_TABLES[period]} WHERE user = ? AND start >= ? AND start < ?",
+            (self.username, day_number(starts[0]), day_number(starts[-1])))
+        usage = {(day_date(start), device): seconds for start, device, seconds in rows}
+        rows = self.conn.execute(
+            "SELECT device, SUM(seconds) FROM daily_rollup WHERE user = ? AND day BETWEEN ? AND ? GROUP BY device",
+            (self.username, day_number(starts[-1]), day_number(last_date)))
+        usage.update(((starts[-1], device), seconds) for device, seconds in rows)
+        return usage
+
+    def sessions_between(self, start_ts, end_ts):
+        """Returns (device name, start, end) sessions overlapping the window, clipped to it."""
+        rows = self.conn.execute(
+            "SELECT ts, device, event FROM events WHERE user = ? AND ts >= ? AND ts <= ? ORDER BY ts, id",
+            (self.username, start_ts, end_ts))
+        return pair_sessions(rows, start_ts, end_ts)
+
+    def leaderboard_totals(self):
+        """Returns {username: saved total} for every user in the database."""
+        return _leaderboard_totals(self.conn)
+
+    def signature(self):
+        """Changes whenever another connection commits to the database."""
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+        self.release_owner()
@@ -0,0 +1,557 @@
+import os
+import queue
+import threading
+from collections import Counter
+from datetime import datetime
+
+import numpy as np
+
+from datafile import read_data_file, write_data_file, append_log_events, forget_parsed_events
+from journal import EventJournal, EVENT_ON, SECONDS_PER_DAY, to_timestamp, from_timestamp, pair_sessions
+from leaderboard import LeaderboardIndex
+from rollup import DailyRollup, RECORD_DTYPE, split_sessions_by_day, day_number, day_date, period_start, period_dates
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+# Values accepted by WATTWISE_STORAGE.
+STORAGE_TEXT = "text"
+STORAGE_JOURNAL = "journal"
+STORAGE_SQLITE = "sqlite"
+
+# Group commit settings for BufferedStore: how often queued events are written, and how
+# many may be queued before toggles wait for a commit instead.
+COMMIT_INTERVAL = float(os.getenv("WATTWISE_COMMIT_INTERVAL", "0.25"))
+COMMIT_QUEUE_SIZE = int(os.getenv("WATTWISE_COMMIT_QUEUE", "1024"))
+
+# Journal events older than this many days are moved into compressed monthly archives.
+HOT_DAYS = int(os.getenv("WATTWISE_HOT_DAYS", "90"))
+
+
+def device_rows(devices):
+    return [(d.name, d.power, d.saved_usage_units) for d in devices]
+
+
+class UserLockedError(RuntimeError):
+    """Raised when another process already owns a user's data."""
+
+
+class UserLock:
+    """Exclusive lock on [username].lock, held by the one process that writes a user's data.
+
+    An in-process GUI, meterd and the importer all take it through open_store, so two
+    of them can never append to the same journal or save over each other. The OS drops
+    the lock when its process exits, so a crash never leaves a user locked out.
+    """
+    def __init__(self, username):
+        self._file = open(f"{username}.lock", "a+")
+        try:
+            if os.name == "nt":
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._file.close()
+            raise UserLockedError(f"{username}'s data is already open in another WattWise window, meterd or an import. "
+                                  "Close it, or attach through the daemon with WATTWISE_DAEMON.")
+
+    def release(self):
+        if self._file is None: return
+        if os.name == "nt":
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        self._file.close()  # Closing releases the flock.
+        self._file = None
+
+
+class UsageStore:
+    """Where a user's devices and ON/OFF history live.
+
+    The app only talks to this interface; the implementations differ in how they lay the
+    data out on disk. Events are (datetime, device name, event type) tuples and
+    timestamps are journal seconds (see journal.to_timestamp).
+    """
+    owner_lock = None  # The UserLock taken by open_store, released on close.
+
+    def load_devices(self):
+        """Returns saved (name, power, saved units) rows, or None if the user has no data yet."""
+        raise NotImplementedError
+
+    def save_devices(self, devices):
+        """Persists the current Device objects."""
+        raise NotImplementedError
+
+    def append_events(self, events):
+        raise NotImplementedError
+
+    def append_bulk(self, timestamps, device_names, events):
+        """Appends events given as parallel numpy arrays of journal seconds, names and event types.
+
+        Bulk importers use this; backends override it to skip the per-event datetime round trip.
+        """
+        self.append_events(zip(map(from_timestamp, timestamps.tolist()), device_names.tolist(), events.tolist()))
+
+    def insert_bulk(self, timestamps, device_names, events):
+        """Adds time-ordered events that are older than the newest recorded one, as numpy arrays.
+
+        Importers backfill history with this. Reads may not reflect the events until
+        finish_inserts() is called.
+        """
+        raise NotImplementedError
+
+    def finish_inserts(self):
+        """Folds the events given to insert_bulk into the store's rollups."""
+
+    def iter_events(self):
+        """Yields the full history as (datetime, device name, event) tuples in time order."""
+        raise NotImplementedError
+
+    def last_timestamp(self):
+        """Returns the journal seconds of the newest recorded event, or None if there are none."""
+        last = None
+        for last in self.iter_events():
+            pass
+        return to_timestamp(last[0]) if last else None
+
+    def usage_between(self, first_date, last_date):
+        """Returns {(date, device name): seconds} of closed sessions in the inclusive range."""
+        raise NotImplementedError
+
+    def usage_by_period(self, first_date, last_date, period):
+        """Returns {(period start date, device name): seconds} of closed sessions per "day",
+        "week" or "month", with the range widened to whole periods.
+
+        This default sums the daily usage; backends with coarser rollups override it.
+        """
+        if period == "day":
+            return self.usage_between(first_date, last_date)
+        first_date = period_dates(first_date, last_date, period)[0]
+        usage, starts = {}, {}
+        for (day, name), seconds in self.usage_between(first_date, last_date).items():
+            if day not in starts:
+                starts[day] = day_date(period_start(day_number(day), period))
+            key = (starts[day], name)
+            usage[key] = usage.get(key, 0) + seconds
+        return usage
+
+    def open_sessions(self):
+        """Returns {device name: ON timestamp} for sessions that have not been closed."""
+        raise NotImplementedError
+
+    def sessions_between(self, start_ts, end_ts):
+        """Returns (device name, start, end) sessions overlapping the window, clipped to it."""
+        raise NotImplementedError
+
+    def leaderboard_totals(self):
+        """Returns {username: saved total} for every known user."""
+        raise NotImplementedError
+
+    def signature(self):
+        """A cheap value that changes when other users' data may have changed."""
+        raise NotImplementedError
+
+    def close(self):
+        self.release_owner()
+
+    def release_owner(self):
+        if self.owner_lock:
+            self.owner_lock.release()
+            self.owner_lock = None
+
+
+class TextStore(UsageStore):
+    """The original single-file format: a DEVICES snapshot followed by a LOGS section of text lines.
+
+    Kept for compatibility with older installs. The file is parsed once per version through
+    datafile's shared cache, and per-day usage is recomputed only when new events arrive.
+    """
+    def __init__(self, username):
+        self.username = username
+        self.data_file = f"{username}_data.txt"
+        self.leaderboard_index = LeaderboardIndex()
+        self._usage_cache = (None, {}, {})  # (event count, per-day usage, open sessions)
+
+    def _data(self):
+        return read_data_file(self.data_file)
+
+    def load_devices(self):
+        data = self._data()
+        return data.devices if data else None
+
+    def save_devices(self, devices):
+        rows = device_rows(devices)
+        write_data_file(self.data_file, rows, keep_logs_from=self._data())
+        self.leaderboard_index.record(self.username, self.data_file, sum(saved for _, _, saved in rows))
+
+    def append_events(self, events):
+        append_log_events(self.data_file, events)
+
+    def insert_bulk(self, timestamps, device_names, events):
+        # The LOGS section is sorted when it is parsed, so older lines can simply be appended.
+        self.append_bulk(timestamps, device_names, events)
+        forget_parsed_events(self.data_file)
+
+    def _events(self):
+        data = self._data()
+        return data.events if data else []
+
+    def iter_events(self):
+        for ts, name, event in self._events():
+            yield from_timestamp(ts), name, event
+
+    def last_timestamp(self):
+        events = self._events()
+        return events[-1][0] if events else None
+
+    def _usage(self):
+        events = self._events()
+        if self._usage_cache[0] != len(events):
+            closed, open_sessions = [], {}
+            for ts, name, event in events:
+                if event == EVENT_ON:
+                    open_sessions[name] = ts
+                elif name in open_sessions:
+                    closed.append((open_sessions.pop(name), ts, name))
+            names = sorted({name for _, _, name in closed})
+            name_ids = {name: i for i, name in enumerate(names)}
+            usage = split_sessions_by_day([c[0] for c in closed], [c[1] for c in closed], [name_ids[c[2]] for c in closed])
+            self._usage_cache = (len(events), {(day, names[i]): seconds for (day, i), seconds in usage.items()}, open_sessions)
+        return self._usage_cache
+
+    def usage_between(self, first_date, last_date):
+        first_day, last_day = day_number(first_date), day_number(last_date)
+        return {(day_date(day), name): seconds for (day, name), seconds in self._usage()[1].items()
+                if first_day <= day <= last_day}
+
+    def open_sessions(self):
+        return dict(self._usage()[2])
+
+    def sessions_between(self, start_ts, end_ts):
+        events = [(ts, name, event) for ts, name, event in self._events() if ts >= start_ts]
+        return pair_sessions(events, start_ts, end_ts)
+
+    def leaderboard_totals(self):
+        return self.leaderboard_index.totals()
+
+    def signature(self):
+        return self.leaderboard_index.signature()
+
+
+class JournalStore(UsageStore):
+    """Default storage: a small device snapshot file plus the binary event journal and daily rollup."""
+    def __init__(self, username):
+        self.username = username
+        self.data_file = f"{username}_data.txt"
+        self.journal = EventJournal(f"{username}_events")
+        self.rollup = DailyRollup(f"{username}_rollup.json")
+        self.rollup.catch_up(self.journal)
+        self.leaderboard_index = LeaderboardIndex()
+        self._backfill = None  # staging file of insert_bulk events
+        self._backfill_before = None
+
+    def load_devices(self):
+        data = read_data_file(self.data_file)
+        if data is None: return None
+        if data.log_lines:
+            self._migrate_legacy_logs(data)
+        return data.devices
+
+    def _migrate_legacy_logs(self, data):
+        """Moves the old '## LOGS ##' text section of the data file into the event journal.
+
+        Entries the journal already holds are skipped, since an interrupted migration may
+        have written only some of them and the text backend may have added new ones since.
+        The section is dropped only once the journal is seen to hold every entry.
+        """
+        missing = self._events_not_in_journal(data.events)
+        if missing:
+            self.append_events((from_timestamp(ts), name, event) for ts, name, event in missing)
+            if self._events_not_in_journal(data.events):
+                raise IOError(f"Could not move the text logs of {self.username} into the event journal.")
+        print(f"Migrated {len(missing)} of {len(data.events)} log entries for {self.username} to the event journal.")
+        self.rollup.save()
+        write_data_file(self.data_file, data.devices)
+
+    def _events_not_in_journal(self, events):
+        """Returns the (ts, name, event) entries that have no matching journal record."""
+        if not events: return []
+        start = self.journal.find_index(events[0][0])
+        if start == self.journal.base_index:
+            start = None  # The entries may reach back into the archives.
+        present = Counter((ts, self.journal.name_of(device_id), event)
+                          for _, ts, device_id, event in self.journal.records(start) if ts >= events[0][0])
+        missing = []
+        for entry in events:
+            if present[entry]:
+                present[entry] -= 1
+            else:
+                missing.append(entry)
+        return missing
+
+    def save_devices(self, devices):
+        # The data file only holds the device snapshot; events live in the journal.
+        rows = device_rows(devices)
+        write_data_file(self.data_file, rows)
+        self.rollup.save()
+        self.compact()
+        self.leaderboard_index.record(self.username, self.data_file, sum(saved for _, _, saved in rows))
+
+    def compact(self, hot_days=HOT_DAYS):
+        """Archives whole months of journal events older than hot_days that the saved rollup covers.
+
+        The cutoff is rounded down to the start of its month, so the hot journal is rewritten
+        about once a month rather than by every save. Stats read per-day totals from the
+        rollup, which keeps every day, so archiving only shrinks the hot journal;
+        iter_events and sessions_between still see it all.
+        """
+        cutoff = period_start(day_number(datetime.now().date()) - hot_days, "month") * SECONDS_PER_DAY
+        archived = self.journal.compact(cutoff, keep_from_index=self.rollup.checkpoint)
+        if archived:
+            print(f"Archived {archived} journal events for {self.username}.")
+        return archived
+
+    def append_events(self, events):
+        events = list(events)
+        index = self.journal.append_many(events, sync=True)
+        for i, (dt, device_name, event) in enumerate(events):
+            self.rollup.apply(index + i, to_timestamp(dt), self.journal.device_id(device_name), event)
+
+    def _pack(self, timestamps, device_names, events):
+        # Packs a whole chunk as journal records with numpy, instead of one struct.pack per event.
+        names, inverse = np.unique(device_names, return_inverse=True)
+        ids = np.array([self.journal.device_id(str(name)) for name in names], dtype=np.uint32)
+        records = np.zeros(len(timestamps), dtype=RECORD_DTYPE)
+        records["ts"] = timestamps
+        records["device"] = ids[inverse]
+        records["event"] = events
+        return records.tobytes()
+
+    def append_bulk(self, timestamps, device_names, events):
+        # The rollup folds the chunk in with its vectorized catch-up rather than apply() per event.
+        self.journal.append_raw(self._pack(timestamps, device_names, events), sync=True)
+        self.rollup.catch_up(self.journal)
+
+    def insert_bulk(self, timestamps, device_names, events):
+        """Stages time-ordered events older than the journal's first one; finish_inserts() prepends them."""
+        if self._backfill is None:
+            self._backfill_before = self.journal.first_timestamp()
+            self._backfill = open(f"{self.journal.prefix}.backfill", "wb")
+        if self._backfill_before is not None and len(timestamps) and timestamps[-1] >= self._backfill_before:
+            overlap = timestamps[np.searchsorted(timestamps, self._backfill_before)]
+            raise ValueError(f"Events from {from_timestamp(int(overlap))} overlap the recorded history, which starts at "
+                             f"{from_timestamp(self._backfill_before)}; the journal can only backfill events older than that.")
+        self._backfill.write(self._pack(timestamps, device_names, events))
+
+    def finish_inserts(self):
+        """Prepends the staged events to the journal and rebuilds the rollup from the oldest record."""
+        if self._backfill is None: return
+        self._backfill.close()
+        path, self._backfill = self._backfill.name, None
+        # The rollup is reset first, so if prepending is interrupted the next open replays what landed.
+        self.rollup.reset()
+        self.rollup.save()
+        inserted = self.journal.prepend(path)
+        os.remove(path)
+        self.rollup.catch_up(self.journal)
+        self.rollup.save()
+        print(f"Backfilled {inserted} journal events for {self.username}.")
+
+    def iter_events(self):
+        for _, ts, device_id, event in self.journal.records():
+            yield from_timestamp(ts), self.journal.name_of(device_id), event
+
+    def last_timestamp(self):
+        return self.journal.last_timestamp()
+
+    def usage_between(self, first_date, last_date):
+        # Closed sessions come from the incrementally maintained rollup, so this only
+        # touches the requested days instead of replaying the whole journal.
+        self.rollup.catch_up(self.journal)
+        return {(date, self.journal.name_of(device_id)): seconds
+                for (date, device_id), seconds in self.rollup.usage_between(first_date, last_date).items()}
+
+    def usage_by_period(self, first_date, last_date, period):
+        self.rollup.catch_up(self.journal)
+        return {(start, self.journal.name_of(device_id)): seconds
+                for (start, device_id), seconds in self.rollup.usage_by_period(first_date, last_date, period).items()}
+
+    def open_sessions(self):
+        return {self.journal.name_of(device_id): ts for device_id, ts in self.rollup.open_sessions.items()}
+
+    def sessions_between(self, start_ts, end_ts):
+        return [(self.journal.name_of(device_id), start, end)
+                for device_id, start, end in self.journal.sessions_between(start_ts, end_ts)]
+
+    def leaderboard_totals(self):
+        return self.leaderboard_index.totals()
+
+    def signature(self):
+        return self.leaderboard_index.signature()
+
+    def close(self):
+        if self._backfill is not None:
+            # An import that failed before finish_inserts() leaves the journal as it was.
+            self._backfill.close()
+            os.remove(self._backfill.name)
+            self._backfill = None
+        self.journal.close()
+        self.release_owner()
+
+
+class BufferedStore(UsageStore):
+    """Wraps another store so appending events never blocks the UI thread on disk I/O.
+
+    Events go into a bounded queue. A background thread sleeps until one arrives, waits
+    `interval` seconds for more and writes them as one batch (one journal write and fsync,
+    one SQLite transaction), so an idle store costs no wakeups. Reads flush the queue first, so callers always see their own
+    writes. If the queue fills up, the caller commits synchronously instead of waiting.
+
+    Durability: a batch is on disk once its commit returns; a crash can lose at most the
+    events queued since the last commit. close() commits everything that is left.
+    A batch that fails is retried with the next one; the wrapped stores leave no trace
+    of a failed append, so the retry never duplicates or loses anything.
+    """
+    def __init__(self, store, interval=COMMIT_INTERVAL, max_pending=COMMIT_QUEUE_SIZE):
+        self.store = store
+        self.interval = interval
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()  # Serializes every access to the wrapped store.
+        self._failed = []
+        self._pending = threading.Event()  # Set when there is something for the writer thread to do.
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="event-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        # An event rather than a blocking get(): flush() also drains the queue from other threads.
+        while not self._stopped.is_set():
+            self._pending.wait()
+            self._stopped.wait(self.interval)  # Lets the rest of the batch arrive.
+            self._pending.clear()
+            self.flush()
+            if self._failed:
+                self._pending.set()  # Retry after another interval.
+
+    def flush(self):
+        """Writes every queued event to the wrapped store as one group commit."""
+        with self._lock:
+            batch, self._failed = self._failed, []
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch: return
+            try:
+                self.store.append_events(batch)
+            except Exception as e:
+                print(f"Error writing {len(batch)} events, will retry: {e}")
+                self._failed = batch
+
+    def append_bulk(self, timestamps, device_names, events):
+        self._read(self.store.append_bulk, timestamps, device_names, events)
+
+    def insert_bulk(self, timestamps, device_names, events):
+        self._read(self.store.insert_bulk, timestamps, device_names, events)
+
+    def finish_inserts(self):
+        self._read(self.store.finish_inserts)
+
+    def append_events(self, events):
+        for event in events:
+            try:
+                self._queue.put_nowait(event)
+            except queue.Full:
+                self.flush()
+                self._queue.put_nowait(event)
+        self._pending.set()
+
+    def _read(self, method, *args):
+        self.flush()
+        with self._lock:
+            return method(*args)
+
+    def load_devices(self):
+        return self._read(self.store.load_devices)
+
+    def save_devices(self, devices):
+        self._read(self.store.save_devices, devices)
+
+    def iter_events(self):
+        return iter(self._read(lambda: list(self.store.iter_events())))
+
+    def last_timestamp(self):
+        return self._read(self.store.last_timestamp)
+
+    def usage_between(self, first_date, last_date):
+        return self._read(self.store.usage_between, first_date, last_date)
+
+    def usage_by_period(self, first_date, last_date, period):
+        return self._read(self.store.usage_by_period, first_date, last_date, period)
+
+    def open_sessions(self):
+        return self._read(self.store.open_sessions)
+
+    def sessions_between(self, start_ts, end_ts):
+        return self._read(self.store.sessions_between, start_ts, end_ts)
+
+    def leaderboard_totals(self):
+        return self._read(self.store.leaderboard_totals)
+
+    def signature(self):
+        return self._read(self.store.signature)
+
+    def close(self):
+        self._stopped.set()
+        self._pending.set()
+        self._thread.join()
+        self.flush()
+        if self._failed:
+            print(f"Could not write {len(self._failed)} events before closing.")
+        with self._lock:
+            self.store.close()
+
+
+def open_leaderboard(kind=None):
+    """Returns an object with totals() and signature() covering every user of the storage backend."""
+    kind = kind or os.getenv("WATTWISE_STORAGE", STORAGE_JOURNAL)
+    if kind == STORAGE_SQLITE:
+        from sqlite_store import SQLiteLeaderboard
+        return SQLiteLeaderboard()
+    return LeaderboardIndex()
+
+
+def open_store(username, kind=None):
+    """Opens the storage backend named by kind or WATTWISE_STORAGE (default: journal).
+
+    The caller becomes the user's owner until the store is closed; raises UserLockedError
+    if another process owns the user.
+    """
+    lock = UserLock(username)
+    try:
+        store = _open_backend(username, kind)
+    except Exception:
+        lock.release()
+        raise
+    store.owner_lock = lock
+    return store
+
+
+def _open_backend(username, kind):
+    kind = kind or os.getenv("WATTWISE_STORAGE", STORAGE_JOURNAL)
+    if kind == STORAGE_TEXT:
+        return TextStore(username)
+    if kind == STORAGE_SQLITE:
+        from sqlite_store import SQLiteStore
+        store = SQLiteStore(username)
+        if store.is_empty() and os.path.exists(f"{username}_data.txt"):
+            legacy = JournalStore(username)
+            try:
+                store.import_from(legacy)
+            finally:
+                legacy.close()
+        return store
+    return JournalStore(username)
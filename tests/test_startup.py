@@ -0,0 +1,40 @@
+"""Startup budget: importing App must not pull in the libraries only Stats and AI use."""
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Seconds a cold `import App` may take; override for slow CI machines.
+IMPORT_BUDGET = float(os.getenv("WATTWISE_IMPORT_BUDGET", "2.0"))
+HEAVY_MODULES = ("pandas", "matplotlib", "seaborn", "google.generativeai")
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import App
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed, "loaded": [m for m in %r if m in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+
+@unittest.skipUnless(importlib.util.find_spec("customtkinter"), "customtkinter is not installed")
+class StartupTest(unittest.TestCase):
+    def import_app(self):
+        # A fresh interpreter, so nothing this test process already imported is counted or hidden.
+        result = subprocess.run([sys.executable, "-c", PROBE], cwd=ROOT, capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return json.loads(result.stdout.strip().splitlines()[-1])
+
+    def test_heavy_modules_load_on_demand(self):
+        self.assertEqual(self.import_app()["loaded"], [])
+
+    def test_import_time_within_budget(self):
+        seconds = self.import_app()["seconds"]
+        self.assertLess(seconds, IMPORT_BUDGET, f"import App took {seconds:.2f}s (budget {IMPORT_BUDGET}s)")
+
+
+if __name__ == "__main__":
+    unittest.main()